@@ -0,0 +1,5 @@
+"""
+benchmarks
+
+Timing harness for fencepy. See benchmarks/run.py.
+"""
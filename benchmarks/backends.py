@@ -0,0 +1,63 @@
+"""
+benchmarks.backends
+
+Compare the time taken to create an environment with each creation backend, against the
+old approach of forking the virtualenv console script.
+
+Usage: python benchmarks/backends.py [ROUNDS]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fencepy import backends, helpers  # noqa: E402
+
+
+def _create_cli(vdir, seed):
+    """The pre-backend behavior: run the console script in a subprocess"""
+    cmd = [helpers.findpybin('virtualenv', sys.executable), '-p', sys.executable, vdir]
+    if not seed:
+        cmd.insert(1, '--no-seed')
+    helpers.getoutputoserror(cmd)
+
+
+def _timed(func, rounds):
+    """Run func(vdir) rounds times in fresh directories, returning the sorted timings"""
+    timings = []
+    for _ in range(rounds):
+        tempdir = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            func(os.path.join(tempdir, 'venv'))
+            timings.append(time.time() - start)
+        finally:
+            shutil.rmtree(tempdir)
+    return sorted(timings)
+
+
+def main(rounds=3):
+    """Print min and median creation time for every backend, with and without seeding"""
+
+    candidates = [('cli', _create_cli)]
+    for backend in backends.BACKENDS:
+        candidates.append((backend, lambda vdir, seed, b=backend: backends.create(b, vdir, seed)))
+
+    print('{0:<12} {1:<6} {2:>8} {3:>8}'.format('backend', 'seed', 'min', 'median'))
+    for name, func in candidates:
+        for seed in (True, False):
+            try:
+                timings = _timed(lambda vdir: func(vdir, seed), rounds)
+            except OSError as e:
+                print('{0:<12} {1:<6} failed: {2}'.format(name, str(seed), e))
+                continue
+            print('{0:<12} {1:<6} {2:>7.3f}s {3:>7.3f}s'.format(
+                name, str(seed), timings[0], timings[len(timings) // 2]
+            ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,69 @@
+"""
+benchmarks.index
+
+Synthetic packages, written as wheels into a directory that pip can use in place of an index
+"""
+
+import base64
+import hashlib
+import os
+import zipfile
+
+VERSION = '1.0'
+WHEEL = b'''Wheel-Version: 1.0
+Generator: fencepy-benchmarks
+Root-Is-Purelib: true
+Tag: py2.py3-none-any
+'''
+
+
+def _record_hash(data):
+    """Return a RECORD-style hash for data"""
+    digest = hashlib.sha256(data).digest()
+    return 'sha256=' + base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def build_wheel(indexdir, name, modules=1, module_size=1024):
+    """Write a pure-python wheel for name into indexdir and return its path
+
+    The package is made up of modules files of roughly module_size bytes each, so the size
+    of the environments it is installed into can be controlled
+    """
+
+    distinfo = '{0}-{1}.dist-info'.format(name, VERSION)
+    files = [('{0}/__init__.py'.format(name), b'')]
+    for i in range(modules):
+        body = '# filler\n'.ljust(module_size, '#') + '\nVALUE = {0}\n'.format(i)
+        files.append(('{0}/module{1}.py'.format(name, i), body.encode()))
+    metadata = 'Metadata-Version: 2.1\nName: {0}\nVersion: {1}\n'.format(name, VERSION)
+    files.append(('{0}/METADATA'.format(distinfo), metadata.encode()))
+    files.append(('{0}/WHEEL'.format(distinfo), WHEEL))
+
+    record = ['{0},{1},{2}'.format(path, _record_hash(data), len(data)) for path, data in files]
+    record.append('{0}/RECORD,,'.format(distinfo))
+    files.append(('{0}/RECORD'.format(distinfo), ('\n'.join(record) + '\n').encode()))
+
+    wheelpath = os.path.join(indexdir, '{0}-{1}-py2.py3-none-any.whl'.format(name, VERSION))
+    with zipfile.ZipFile(wheelpath, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path, data in files:
+            zf.writestr(path, data)
+    return wheelpath
+
+
+def build_index(indexdir, count, modules=1, module_size=1024):
+    """Build count synthetic packages into indexdir, returning their names"""
+    if not os.path.exists(indexdir):
+        os.makedirs(indexdir)
+    names = ['fencepybench{0}'.format(i) for i in range(count)]
+    for name in names:
+        build_wheel(indexdir, name, modules, module_size)
+    return names
+
+
+def pip_environ(indexdir):
+    """Return environment variables that point pip at indexdir and nothing else"""
+    return {
+        'PIP_NO_INDEX': '1',
+        'PIP_FIND_LINKS': indexdir,
+        'PIP_DISABLE_PIP_VERSION_CHECK': '1'
+    }
@@ -0,0 +1,198 @@
+"""
+benchmarks.run
+
+Time fencepy's commands against synthetic projects and a local package index, and keep the
+results so that releases can be compared.
+
+Usage:
+  python -m benchmarks.run [options]
+
+Options:
+  -e N --envs=N           Number of other environments under the fencepy root [default: 10]
+  -r N --requirements=N   Number of packages in each requirements.txt [default: 5]
+  -m N --modules=N        Number of modules in each package [default: 50]
+  -p N --depth=N          Depth of the project directories [default: 5]
+  -n N --rounds=N         Number of times to run each measurement [default: 3]
+  -o DIR --output=DIR     Directory to store results in [default: benchmarks/results]
+  -c FILE --compare=FILE  Compare against an earlier results file
+  -t PCT --threshold=PCT  Slowdown, in percent, that counts as a regression [default: 20]
+"""
+
+import datetime
+import docopt
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+# the checkout being measured, which children must import fencepy from as well
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+import fencepy  # noqa: E402
+from fencepy import helpers  # noqa: E402
+from benchmarks import index  # noqa: E402
+
+# shellfuncs writes to the home directory, so leave it out
+PLUGINS = ['requirements', 'sublime', 'ps1']
+
+MEASUREMENTS = ['create_cold', 'create_warm', 'update_noop', 'activate', 'erase']
+
+
+def _make_project(root, name, depth, requirements):
+    """Create a project directory depth levels below root, with a requirements.txt"""
+    pdir = os.path.join(root, *(['level{0}'.format(i) for i in range(depth)] + [name]))
+    os.makedirs(pdir)
+    open(os.path.join(pdir, 'requirements.txt'), 'w').write('\n'.join(requirements) + '\n')
+    return pdir
+
+
+def _populate(fdir, template, count):
+    """Fill the fencepy root with count copies of an existing environment"""
+    venv_root = os.path.dirname(template)
+    for i in range(count):
+        shutil.copytree(template, os.path.join(venv_root, 'filler{0}-{1}'.format(
+            i, helpers.pyversionstr())), symlinks=True)
+
+
+def _timed(func):
+    """Run func, returning the wall clock time it took"""
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def _check(result):
+    """Fail loudly if an api call did not succeed"""
+    if not result.ok:
+        raise RuntimeError('{0} failed with status {1}'.format(result.command, result.status))
+
+
+def _activate_cmd(fdir, pdir):
+    """The command line for a cold run of fencepy activate"""
+    return [sys.executable, '-c', 'import sys, fencepy; sys.exit(fencepy.fence())',
+            'activate', '-s', '-G', '-F', fdir, '-d', pdir]
+
+
+def _activate_environ():
+    """The environment for _activate_cmd, which imports fencepy from the checkout no matter
+    where the benchmarks are run from"""
+    paths = [REPO_ROOT] + [x for x in [os.environ.get('PYTHONPATH')] if x]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+
+
+def _round(workdir, indexdir, names, args, number):
+    """Run every measurement once in a fresh fencepy root"""
+
+    fdir = os.path.join(workdir, 'fencepy{0}'.format(number))
+    options = {'fencepy_root': fdir, 'git': False, 'plugins': PLUGINS}
+    depth = int(args['--depth'])
+    projects = [_make_project(workdir, 'project{0}-{1}'.format(number, i), depth, names)
+                for i in range(2)]
+
+    # nothing is cached when the first environment is created
+    helpers._pybin_memo.clear()
+    timings = OrderedDict()
+    timings['create_cold'] = _timed(lambda: _check(fencepy.create(projects[0], **options)))
+
+    env = fencepy.resolve(projects[0], **options)
+    _populate(fdir, env.virtualenv_dir, int(args['--envs']))
+
+    timings['create_warm'] = _timed(lambda: _check(fencepy.create(projects[1], **options)))
+    timings['update_noop'] = _timed(lambda: _check(fencepy.update(env)))
+    activate_environ = _activate_environ()
+    timings['activate'] = _timed(lambda: subprocess.check_output(
+        _activate_cmd(fdir, projects[0]), env=activate_environ
+    ))
+    timings['erase'] = _timed(lambda: _check(fencepy.erase(env)))
+
+    return timings
+
+
+def _summarize(rounds):
+    """Reduce per-round timings to min/median for each measurement"""
+    ret = OrderedDict()
+    for name in MEASUREMENTS:
+        values = sorted(r[name] for r in rounds)
+        ret[name] = OrderedDict([
+            ('min', values[0]),
+            ('median', values[len(values) // 2]),
+            ('rounds', [r[name] for r in rounds])
+        ])
+    return ret
+
+
+def compare(old, new, threshold):
+    """Print the change in median time for each measurement, returning the regressions"""
+    regressions = []
+    for name, stats in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['median']
+        ratio = stats['median'] / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + threshold / 100.0:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{0:<12} {1:>8.3f}s -> {2:>8.3f}s  x{3:.2f}{4}'.format(
+            name, before, stats['median'], ratio, flag
+        ))
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks and store the results"""
+
+    args = docopt.docopt(__doc__, argv=argv)
+    workdir = tempfile.mkdtemp()
+    saved_environ = dict(os.environ)
+    try:
+        indexdir = os.path.join(workdir, 'index')
+        names = index.build_index(indexdir, int(args['--requirements']), int(args['--modules']))
+        os.environ.update(index.pip_environ(indexdir))
+        rounds = [_round(workdir, indexdir, names, args, i) for i in range(int(args['--rounds']))]
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        shutil.rmtree(workdir)
+
+    results = OrderedDict([
+        ('version', fencepy.__version__),
+        ('python', helpers.pyversionstr()),
+        ('time', datetime.datetime.utcnow().isoformat()),
+        ('params', OrderedDict((k.lstrip('-'), args[k]) for k in (
+            '--envs', '--requirements', '--modules', '--depth', '--rounds'
+        ))),
+        ('results', _summarize(rounds))
+    ])
+
+    for name, stats in results['results'].items():
+        print('{0:<12} min {1:>8.3f}s  median {2:>8.3f}s'.format(
+            name, stats['min'], stats['median']
+        ))
+
+    if not os.path.exists(args['--output']):
+        os.makedirs(args['--output'])
+    outfile = os.path.join(args['--output'], '{0}-{1}.json'.format(
+        datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'), results['python']
+    ))
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {0}'.format(outfile))
+
+    if args['--compare']:
+        with open(args['--compare']) as f:
+            old = json.load(f)
+        if old['params'] != results['params']:
+            print('warning: {0} was run with different parameters'.format(args['--compare']))
+        if compare(old, results, float(args['--threshold'])):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
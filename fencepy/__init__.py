@@ -6,5 +6,21 @@ Includes special processing if the directory is part of a git repository.  Also
 configuration for users of sublime text
 """
 
+import sys
 from ._version import __version__, __version_info__  # flake8: noqa
-from .main import fence  # flake8: noqa
+from .api import Environment, Result, resolve, create, update, erase  # flake8: noqa
+
+
+def fence(argv=None):
+    """Main entry point, taking the command line from argv or sys.argv
+
+    Shell prompts run "status" constantly, so it is answered without importing the rest of
+    the command line interface whenever it can be
+    """
+    from . import status
+    args = status.parse_args(sys.argv[1:] if argv is None else argv)
+    if args is not None:
+        return status.run(args)
+
+    from . import main
+    return main.fence(argv)
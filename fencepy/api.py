@@ -0,0 +1,105 @@
+"""
+fencepy.api
+
+Importable interface for tools that drive fencepy from their own process
+
+Nothing here reads sys.argv, configures logging or creates directories beyond what the
+requested operation itself needs, so a single process can run any number of operations.
+"""
+
+import copy
+import os
+from collections import namedtuple
+
+
+class Environment(namedtuple('Environment', [
+        'project', 'virtualenv_dir', 'fencepy_root', 'args'])):
+    """A project and the fenced environment that belongs to it
+
+    project -- str, the project directory (the root of its git repository, if any)
+    virtualenv_dir -- str, where the environment lives
+    fencepy_root -- str, the fencepy tree the environment belongs to
+    args -- dict, the fully resolved arguments, as fencepy's commands take them
+    """
+
+    __slots__ = ()
+
+    @property
+    def exists(self):
+        """bool, whether the environment has been created"""
+        return os.path.exists(self.virtualenv_dir)
+
+
+class Result(namedtuple('Result', ['command', 'status', 'environment'])):
+    """The outcome of running a command against an environment
+
+    command -- str, the name of the command
+    status -- int, the command's exit status
+    environment -- Environment, what the command was run against
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """bool, whether the command succeeded"""
+        return self.status == 0
+
+
+def resolve(project=None, fencepy_root='~/.fencepy', virtualenv_dir=None, git=True,
+            config_file=None, plugins=None, sublime_project_dir=None, backend='virtualenv',
+            seed=True, offline=False):
+    """Work out which environment belongs to project (default: the working directory)
+
+    The keyword arguments mirror the command line options of the same names; plugins is
+    a list of plugin names. Returns an Environment.
+    """
+
+    # imported here rather than at the top, so that importing fencepy stays cheap
+    from . import main
+    args = copy.deepcopy(main._get_default_args())
+    args.update({
+        '--dir': project,
+        '--fencepy-root': fencepy_root,
+        '--virtualenv-dir': virtualenv_dir,
+        '--no-git': not git,
+        '--plugins': ','.join(plugins) if plugins is not None else None,
+        '--sublime-project-dir': sublime_project_dir,
+        '--backend': backend,
+        '--no-seed': not seed,
+        '--offline': offline
+    })
+    if config_file is not None:
+        args['--config-file'] = config_file
+
+    main._resolve_paths(args)
+    main._load_config(args)
+    return Environment(args['--dir'], args['--virtualenv-dir'], args['--fencepy-root'], args)
+
+
+def _run(command, project, options):
+    """Resolve an environment and run one of fencepy's commands against it"""
+    from . import main
+    env = project if isinstance(project, Environment) else resolve(project, **options)
+    args = copy.deepcopy(env.args)
+    args[command] = True
+    main._migrate(args)
+    return Result(command, getattr(main, '_{0}'.format(command))(args), env)
+
+
+def create(project=None, **options):
+    """Create the environment for project, which may also be an Environment
+
+    Takes the same keyword arguments as resolve(). Returns a Result.
+    """
+    return _run('create', project, options)
+
+
+def update(project=None, **options):
+    """Rerun the plugins against the environment for project. Returns a Result."""
+    return _run('update', project, options)
+
+
+def erase(project=None, **options):
+    """Remove the environment for project. Returns a Result."""
+    return _run('erase', project, options)
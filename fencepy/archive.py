@@ -0,0 +1,111 @@
+"""
+fencepy.archive
+
+Streaming export and import of environments as compressed, relocatable archives
+"""
+
+import io
+import json
+import os
+import shutil
+import tarfile
+from . import helpers
+from . import registry
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# the first member of every archive, describing where the environment came from
+HEADER = 'fencepy-export.json'
+
+# everything else lives under this directory in the archive
+PREFIX = 'env'
+
+
+def export_env(vdir, fileobj):
+    """Write vdir to fileobj as a gzipped tar stream, preceded by a json header"""
+
+    header = json.dumps({
+        'virtualenv': os.path.abspath(vdir),
+        'python': helpers.pyversionstr(),
+        'metadata': registry.read_metadata(vdir)
+    }, indent=2, sort_keys=True).encode('utf-8')
+
+    with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+        info = tarfile.TarInfo(HEADER)
+        info.size = len(header)
+        tar.addfile(info, io.BytesIO(header))
+        tar.add(vdir, arcname=PREFIX)
+
+
+def _check_path(staging, name):
+    """Refuse a path in the archive that is outside the environment, or that would be
+    written through a symlink extracted earlier"""
+
+    name = os.path.normpath(name)
+    if os.path.isabs(name) or name.startswith('..') or \
+            not (name == PREFIX or name.startswith(PREFIX + os.sep)):
+        raise IOError('refusing to extract {0}'.format(name))
+
+    # the archive's own symlinks may point anywhere, so nothing may be extracted through
+    # one, or on top of one
+    path = staging
+    for part in name.split(os.sep):
+        path = os.path.join(path, part)
+        if os.path.islink(path):
+            raise IOError('refusing to extract {0} through a symlink'.format(name))
+
+
+def _check_member(staging, member):
+    """Refuse archive members that would land outside the environment, or that are device
+    files or fifos, which no environment contains"""
+    if member.isdev():
+        raise IOError('refusing to extract special file {0}'.format(member.name))
+    _check_path(staging, member.name)
+    if member.islnk():
+        _check_path(staging, member.linkname)
+
+
+def import_env(fileobj, vdir):
+    """Unpack an exported environment from fileobj into vdir, returning the archive's header
+
+    Members are extracted as they are read, into a directory next to vdir that is renamed
+    into place at the end. Paths to the original location in scripts are then rewritten.
+    """
+
+    staging = '{0}.import'.format(vdir)
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+            first = tar.next()
+            if first is None or first.name != HEADER:
+                raise IOError('not a fencepy export: missing {0}'.format(HEADER))
+            header = json.loads(tar.extractfile(first).read().decode('utf-8'))
+            if header['python'] != helpers.pyversionstr():
+                raise IOError('archive is for {0}, not {1}'.format(
+                    header['python'], helpers.pyversionstr()
+                ))
+
+            # links to absolute paths are expected (the base interpreter), and every member
+            # is checked before it's extracted; the tar filter still strips setuid bits and
+            # ownership, without refusing those links the way the data filter would
+            kwargs = {}
+            if hasattr(tarfile, 'tar_filter'):
+                kwargs['filter'] = 'tar'
+            for member in tar:
+                if member is first:
+                    continue
+                _check_member(staging, member)
+                tar.extract(member, staging, **kwargs)
+
+        os.rename(os.path.join(staging, PREFIX), vdir)
+    finally:
+        shutil.rmtree(staging)
+
+    count = registry.relocate(vdir, header['virtualenv'], os.path.abspath(vdir))
+    l.debug('rewrote {0} files that referred to {1}'.format(count, header['virtualenv']))
+    return header
@@ -0,0 +1,90 @@
+"""
+fencepy.backends
+
+Virtual environment creation, done in-process rather than by forking a console script
+"""
+
+import os
+import platform
+import sys
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+BACKENDS = ['virtualenv', 'venv']
+
+
+def _create_virtualenv(vdir, seed):
+    """Create an environment through virtualenv's python api
+
+    Run over an existing environment, this refreshes the interpreter and scripts while
+    leaving installed packages alone
+    """
+    import virtualenv
+
+    # virtualenv>=20 exposes its command line as a function
+    if hasattr(virtualenv, 'cli_run'):
+        cmd = ['-p', sys.executable, vdir]
+        if not seed:
+            cmd.insert(0, '--no-seed')
+        virtualenv.cli_run(cmd, setup_logging=False)
+
+    # older releases were a single module with a creation function
+    else:
+        virtualenv.create_environment(
+            vdir, no_setuptools=not seed, no_pip=not seed, no_wheel=not seed
+        )
+
+
+def _create_venv(vdir, seed):
+    """Create an environment with the standard library's venv module"""
+    import venv
+    builder = venv.EnvBuilder(symlinks=platform.system() != 'Windows', with_pip=seed,
+                              upgrade=os.path.exists(vdir))
+    builder.create(vdir)
+
+
+def create(backend, vdir, seed=True):
+    """Create a virtual environment at vdir, raising OSError on any failure
+
+    If seed is False, pip is not installed into the new environment
+    """
+
+    if backend not in BACKENDS:
+        raise OSError('unknown backend {0}, choose from: {1}'.format(
+            backend, ', '.join(BACKENDS)
+        ))
+
+    try:
+        globals()['_create_{0}'.format(backend)](vdir, seed)
+    except OSError:
+        raise
+    except (Exception, SystemExit) as e:
+        raise OSError('{0} backend failed to create {1}: {2}'.format(backend, vdir, e))
+
+
+def detect(vdir):
+    """Guess which backend created an existing environment"""
+    cfg = read_pyvenv_cfg(vdir)
+    if cfg is not None and 'virtualenv' not in cfg:
+        return 'venv'
+    return 'virtualenv'
+
+
+def read_pyvenv_cfg(vdir):
+    """Return the key/value pairs in an environment's pyvenv.cfg, or None if there isn't one"""
+    cfgpath = os.path.join(vdir, 'pyvenv.cfg')
+    if not os.path.exists(cfgpath):
+        return None
+    ret = {}
+    for line in open(cfgpath).read().splitlines():
+        if '=' in line:
+            key, value = line.split('=', 1)
+            ret[key.strip()] = value.strip()
+    return ret
+
+
+def repair(vdir):
+    """Relink an existing environment to the running interpreter, keeping its packages"""
+    create(detect(vdir), vdir, seed=False)
@@ -0,0 +1,145 @@
+"""
+fencepy.dedupe
+
+Replace byte-identical files across environments with hardlinks to a single copy
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import stat
+import tempfile
+from multiprocessing.pool import ThreadPool
+from . import helpers
+from . import registry
+from . import snapshots
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# path -> stamp and digest of every file hashed so far, under the fencepy root
+HASH_CACHE = 'dedupe.json'
+
+# scripts are rewritten when environments move, and the rest of these are edited in place,
+# so none of them can safely share an inode. pip removes files before writing new versions,
+# so everything else can.
+SKIP_DIRS = ('bin', 'Scripts')
+SKIP_PATTERNS = snapshots.COPY_PATTERNS + (registry.METADATA,)
+
+
+def get_cache_file(fencepy_root):
+    """Return the path to the hash cache under the fencepy root"""
+    return os.path.join(fencepy_root, HASH_CACHE)
+
+
+def _stamp(st):
+    """Return the parts of a stat result that tell whether a file's content may have changed"""
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+def scan(vdir):
+    """Return (path, stat) for every file in vdir that may be replaced with a hardlink"""
+    ret = []
+    for path, dirs, files in os.walk(vdir):
+        if path == vdir:
+            dirs[:] = [x for x in dirs if x not in SKIP_DIRS]
+        for name in files:
+            if any(fnmatch.fnmatch(name, x) for x in SKIP_PATTERNS):
+                continue
+            filepath = os.path.join(path, name)
+            st = os.lstat(filepath)
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                ret.append((filepath, st))
+    return ret
+
+
+def _sha256(filepath):
+    """Return the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _replace_with_link(src, dst):
+    """Atomically replace dst with a hardlink to src"""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.{0}.'.format(
+        os.path.basename(dst)
+    ))
+    os.close(fd)
+    os.remove(tmppath)
+    try:
+        os.link(src, tmppath)
+        os.rename(tmppath, dst)
+    finally:
+        if os.path.lexists(tmppath):
+            os.remove(tmppath)
+
+
+def dedupe(vdirs, fencepy_root, processes=8):
+    """Hardlink identical files across vdirs together, returning (files linked, bytes freed)
+
+    Files are grouped by device, size and mode, and only those in groups of two or more are
+    hashed, reusing the cached digest of any file whose inode, size and mtime are unchanged.
+    Files that change between hashing and linking are left alone. Bytes are only counted as
+    freed when the replaced file had no other links.
+    """
+
+    pool = ThreadPool(processes)
+    try:
+        candidates = {}
+        for found in pool.map(scan, vdirs):
+            for filepath, st in found:
+                key = (st.st_dev, st.st_size, st.st_mode)
+                candidates.setdefault(key, []).append((filepath, st))
+        candidates = [x for x in candidates.values() if len(x) > 1]
+
+        cachefile = get_cache_file(fencepy_root)
+        cache = helpers.read_json(cachefile, {})
+        tohash = [filepath for group in candidates for filepath, st in group
+                  if cache.get(filepath, [None] * 4)[:3] != _stamp(st)]
+        l.debug('hashing {0} files, {1} cached'.format(
+            len(tohash), sum(len(x) for x in candidates) - len(tohash)
+        ))
+        digests = dict(zip(tohash, pool.map(_sha256, tohash)))
+    finally:
+        pool.close()
+
+    linked = freed = 0
+    newcache = {}
+    for group in candidates:
+        byhash = {}
+        for filepath, st in sorted(group, key=lambda x: x[0]):
+            digest = digests.get(filepath) or cache[filepath][3]
+            newcache[filepath] = _stamp(st) + [digest]
+            byhash.setdefault(digest, []).append((filepath, st))
+
+        for digest, files in byhash.items():
+            src, srcst = files[0]
+            for filepath, st in files[1:]:
+                if st.st_ino == srcst.st_ino:
+                    continue
+                try:
+                    current = os.lstat(filepath)
+                    changed = _stamp(current) != _stamp(st) or \
+                        _stamp(os.lstat(src)) != _stamp(srcst)
+                except OSError:
+                    changed = True
+                if changed:
+                    l.debug('{0} changed while deduplicating, skipping it'.format(filepath))
+                    continue
+                try:
+                    _replace_with_link(src, filepath)
+                except (OSError, AttributeError) as e:
+                    l.warning('could not link {0}: {1}'.format(filepath, e))
+                    continue
+                newcache[filepath] = _stamp(srcst) + [digest]
+                linked += 1
+                if current.st_nlink == 1:
+                    freed += st.st_size
+
+    helpers.atomic_write(cachefile, json.dumps(newcache, sort_keys=True))
+    return linked, freed
@@ -0,0 +1,208 @@
+"""
+fencepy.doctor
+
+Health checks for fenced environments, and targeted repairs for whatever is broken
+"""
+
+import os
+import sys
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from . import backends
+from . import helpers
+from . import plugins
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# checks are run in this order, which is also the order that repairs need to happen in
+CHECKS = ['interpreter', 'pyvenv', 'pip', 'activate', 'requirements']
+
+
+def _check_interpreter(vdir, pdir):
+    """The environment's python must exist and resolve to a real file"""
+    bindir = os.path.join(vdir, helpers.getpybindir())
+    for name in ('python', 'python.exe'):
+        python = os.path.join(bindir, name)
+        if os.path.lexists(python):
+            if not os.path.exists(python):
+                return '{0} points to missing {1}'.format(python, os.path.realpath(python))
+            return None
+    return 'no python interpreter in {0}'.format(bindir)
+
+
+def _check_pyvenv(vdir, pdir):
+    """pyvenv.cfg, where there is one, must point at an existing base interpreter"""
+    cfg = backends.read_pyvenv_cfg(vdir)
+    if cfg is None:
+        return None
+    if 'home' not in cfg or not os.path.isdir(cfg['home']):
+        return 'pyvenv.cfg home {0} does not exist'.format(cfg.get('home'))
+    for key in ('executable', 'base-executable'):
+        if key in cfg and not os.path.exists(cfg[key]):
+            return 'pyvenv.cfg {0} {1} does not exist'.format(key, cfg[key])
+    return None
+
+
+def _check_pip(vdir, pdir):
+    """An environment that was seeded with pip must have both the script and the package"""
+    script = os.path.exists(os.path.join(vdir, helpers.getpybindir(), 'pip')) or \
+        os.path.exists(os.path.join(vdir, helpers.getpybindir(), 'pip.exe'))
+    package = 'pip' in helpers.installed_names(vdir)
+    if script != package:
+        return 'pip is only partially installed'
+    return None
+
+
+def _check_activate(vdir, pdir):
+    """Activate scripts must not contain anything the ps1 plugin would still replace"""
+    for filename, trans in plugins.get_ps1_mods(vdir, '').items():
+        filepath = os.path.join(vdir, helpers.getpybindir(), filename)
+        if os.path.exists(filepath) and trans['from'] in open(filepath).read():
+            return '{0} has not been patched'.format(filepath)
+    return None
+
+
+def _missing_requirements(vdir, pdir):
+    """Return the requirement lines of a project that aren't installed in its environment"""
+    rtxt = os.path.join(pdir, 'requirements.txt')
+    if not os.path.exists(rtxt):
+        return []
+    installed = helpers.installed_names(vdir)
+    return [line for name, line in helpers.read_requirements(rtxt) if name not in installed]
+
+
+def _check_requirements(vdir, pdir):
+    """Everything named in requirements.txt must be installed"""
+    missing = _missing_requirements(vdir, pdir)
+    if missing:
+        return 'missing requirements: {0}'.format(', '.join(missing))
+    return None
+
+
+def _repair_interpreter(args):
+    """Relink the environment to the running interpreter and regenerate its scripts"""
+    backends.repair(args['--virtualenv-dir'])
+
+
+def _repair_pip(args):
+    """Reinstall pip with ensurepip"""
+    python = helpers.findpybin('python', args['--virtualenv-dir'])
+    helpers.getoutputoserror([python, '-m', 'ensurepip', '--upgrade', '--default-pip'],
+                             args['settings']['limits'])
+
+
+def _repair_activate(args):
+    """Rerun the ps1 plugin"""
+    if plugins.install('ps1', dict(args, plugins={'ps1': {'enabled': True}})):
+        raise OSError('ps1 plugin failed')
+
+
+def _repair_requirements(args):
+    """Install only the requirements that are missing"""
+    vdir = args['--virtualenv-dir']
+    missing = _missing_requirements(vdir, args['--dir'])
+    if missing:
+        helpers.getoutputoserror(
+            plugins.pip_command(vdir, args['--fencepy-root']) + ['install'] + missing,
+            args['settings']['limits']
+        )
+
+
+# the pyvenv.cfg and the interpreter are repaired together
+REPAIRS = OrderedDict([
+    ('interpreter', _repair_interpreter),
+    ('pyvenv', _repair_interpreter),
+    ('pip', _repair_pip),
+    ('activate', _repair_activate),
+    ('requirements', _repair_requirements)
+])
+
+# checks and repairs that need to know which project an environment belongs to
+PROJECT_CHECKS = ('requirements',)
+PROJECT_REPAIRS = ('activate', 'requirements')
+
+
+def check(vdir, pdir=None):
+    """Run all checks against an environment, returning a dict of check name -> problem
+
+    A problem is None if the check passed. Checks that need the project directory are
+    skipped when pdir is None.
+    """
+    ret = OrderedDict()
+    for name in CHECKS:
+        if pdir is None and name in PROJECT_CHECKS:
+            continue
+        ret[name] = globals()['_check_{0}'.format(name)](vdir, pdir)
+    return ret
+
+
+def _interpreter_version_ok(vdir):
+    """An environment based on a different python version can't be relinked from here"""
+    cfg = backends.read_pyvenv_cfg(vdir) or {}
+    version = cfg.get('version_info', cfg.get('version', ''))
+    return not version or version.split('.')[:2] == [str(x) for x in sys.version_info[:2]]
+
+
+def repair(args, problems):
+    """Repair the problems found in the environment described by args
+
+    Every check is rerun just before its repair would happen, since earlier repairs can
+    fix (or, like regenerated activate scripts, undo) later ones. Returns the results of
+    a final round of checks.
+    """
+
+    vdir = args['--virtualenv-dir']
+    pdir = args['--dir']
+    attempted = set()
+    for name in problems:
+        func = REPAIRS[name]
+        if func in attempted or globals()['_check_{0}'.format(name)](vdir, pdir) is None:
+            continue
+        if pdir is None and name in PROJECT_REPAIRS:
+            l.warning('project for {0} is unknown, not repairing {1}'.format(vdir, name))
+            continue
+        if func is _repair_interpreter and not _interpreter_version_ok(vdir):
+            l.error('{0} was built for another python version, not repairing'.format(vdir))
+            continue
+
+        l.info('repairing {0} in {1}'.format(name, vdir))
+        attempted.add(func)
+        try:
+            func(args)
+        except OSError as e:
+            l.error(str(e))
+
+    return check(vdir, pdir)
+
+
+def doctor(envs, args, fix=True, processes=8):
+    """Check (and optionally repair) a list of (virtualenv dir, project dir) pairs
+
+    Checks run in parallel. Repairs run one environment at a time, since they can involve
+    creating environments in-process. Returns a list of report dicts, one per environment.
+    """
+
+    pool = ThreadPool(processes)
+    try:
+        results = pool.map(lambda env: check(*env), envs)
+    finally:
+        pool.close()
+
+    report = []
+    for (vdir, pdir), problems in zip(envs, results):
+        after = problems
+        if fix and any(problems.values()):
+            envargs = dict(args, **{'--virtualenv-dir': vdir, '--dir': pdir})
+            after = repair(envargs, problems)
+        report.append(OrderedDict([
+            ('virtualenv', vdir),
+            ('project', pdir),
+            ('problems', OrderedDict((k, v) for k, v in problems.items() if v is not None)),
+            ('repaired', OrderedDict((k, after[k] is None)
+                                     for k, v in problems.items() if v is not None and fix)),
+            ('healthy', not any(after.values()))
+        ]))
+
+    return report
@@ -6,34 +6,52 @@ Shared/generic functions
 
 import os
 import fnmatch
+import glob
+import json
 import platform
-import psutil
+import re
+import shutil
 import subprocess
 import sys
-import funcy
+import tempfile
 import six
 from contextlib import contextmanager
+from . import resources
+
+# executables that are resolved together whenever an environment is inspected
+PYBIN_NAMES = ('python', 'pip', 'virtualenv')
+
+# name of the on-disk cache of resolved executables
+PYBIN_CACHE = 'pybins.json'
+
+# in-process copy of the on-disk cache
+_pybin_memo = {}
 
 
 def pseudo_merge_dict(dto, dfrom):
-    """Recursively merge dict objects, overwriting any non-dict values"""
+    """Recursively merge dict objects, overwriting any non-dict values
+
+    Returns True if dto was changed by the merge, so callers can skip writing out no-ops
+    """
 
     # a quick type check
-    if not (type(dto) == dict and type(dfrom) == dict):
+    if not (isinstance(dto, dict) and isinstance(dfrom, dict)):
         raise ValueError('non-dict passed into _psuedo_merge_dict')
 
     # do the work
+    changed = False
     for k, v in dfrom.items():
-        if k not in dto.keys():
-            dto[k] = v
 
         # recurse on further dicts
-        elif type(dfrom[k]) == dict:
-            pseudo_merge_dict(dto[k], dfrom[k])
+        if k in dto and isinstance(v, dict) and isinstance(dto[k], dict):
+            changed = pseudo_merge_dict(dto[k], v) or changed
 
         # everything else can just be overwritten
-        else:
-            dto[k] = dfrom[k]
+        elif k not in dto or dto[k] != v:
+            dto[k] = v
+            changed = True
+
+    return changed
 
 
 def locate_subdirs(pattern, root):
@@ -46,13 +64,27 @@ def locate_subdirs(pattern, root):
     return ret
 
 
-def getoutputoserror(cmd):
-    """Similar behavior to commands.getstatusoutput for python 3 and windows support"""
-    p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    p.wait()
+def getoutputoserror(cmd, limits=None):
+    """Similar behavior to commands.getstatusoutput for python 3 and windows support
+
+    cmd may be a string, which is split on whitespace, or a list of arguments. If the
+    [limits] settings are given, the command runs with the priority and build parallelism
+    they configure.
+    """
+    if isinstance(cmd, six.string_types):
+        cmd = cmd.split()
+    env = resources.get_environ(limits) if limits else None
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    if limits:
+        try:
+            resources.lower_priority(p.pid, limits)
+        except Exception:
+            p.kill()
+            p.wait()
+            raise
     output = p.communicate()[0].decode()
     if p.returncode:
-        raise OSError(p.returncode, '{0}: {1}'.format(cmd, output))
+        raise OSError(p.returncode, '{0}: {1}'.format(' '.join(cmd), output))
     return output
 
 
@@ -63,42 +95,183 @@ def getpybindir():
     return 'bin'
 
 
-def findpybin(name, start):
-    """For windows compatibility"""
+def atomic_write(filepath, text):
+    """Write text to filepath such that readers never see a partial file
+
+    The file is replaced rather than modified, so any hardlinks to it are left untouched
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)),
+                                   prefix='.{0}.'.format(os.path.basename(filepath)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmppath)
+        else:
+            os.chmod(tmppath, 0o644)
+        if hasattr(os, 'replace'):
+            os.replace(tmppath, filepath)
+        else:
+            if platform.system() == 'Windows' and os.path.exists(filepath):
+                os.remove(filepath)
+            os.rename(tmppath, filepath)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
 
-    # normalize to the root of the environment
+
+def read_json(filepath, default=None):
+    """Load json from filepath, returning default if it is missing or unreadable"""
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def _pybin_rootpath(start):
+    """Normalize start to the root of the environment"""
     rootpath = os.path.dirname(start) if os.path.isfile(start) else start
     if os.path.basename(rootpath) in ('bin', 'Scripts'):
         rootpath = os.path.dirname(rootpath)
+    return rootpath
+
+
+def _scan_pybins(rootpath, names):
+    """Look up all names relative to rootpath, listing each candidate directory only once"""
+
+    found = dict((name, None) for name in names)
+    stamps = {}
 
     # special case for Ubuntu (and other?) packaged python instances
+    candidates = [(os.path.join(rootpath, 'bin'), ''), (os.path.join(rootpath, 'Scripts'), '.exe')]
     if rootpath == '/usr':
-        binpath = os.path.join('/usr/local/bin', name)
-        if os.path.exists(binpath):
-            return binpath
-
-    # we're in a linux-based virtual environment
-    if 'bin' in os.listdir(rootpath):
-        binpath = os.path.join(rootpath, 'bin', name)
-        if os.path.exists(binpath):
-            return binpath
-
-    # we're in a windows virtual environment
-    elif 'Scripts' in os.listdir(rootpath):
-        binpath = os.path.join(rootpath, 'Scripts', '{0}.exe'.format(name))
-        if os.path.exists(binpath):
-            return binpath
-
-    # we could be in a brew environment on osx
+        candidates.insert(0, ('/usr/local/bin', ''))
+
+    for bindir, ext in candidates:
+        try:
+            entries = set(os.listdir(bindir))
+        except OSError:
+            continue
+        stamps[bindir] = os.path.getmtime(bindir)
+        for name in names:
+            if found[name] is None and name + ext in entries:
+                found[name] = os.path.join(bindir, name + ext)
+
+    # we could be in a brew environment on osx, no other platform needs the subprocess
+    if None in found.values() and platform.system() == 'Darwin':
+        try:
+            output = getoutputoserror('brew config')
+            match = re.search(r'HOMEBREW_PREFIX:\s+([/\w]+)', output)
+            prefix = match.group(1) if match else None
+            if prefix and prefix != rootpath:
+                missing = [name for name, path in found.items() if path is None]
+                brewfound, brewstamps = _scan_pybins(prefix, missing)
+                found.update(brewfound)
+                stamps.update(brewstamps)
+        except OSError:
+            pass
+
+    return found, stamps
+
+
+def _pybin_stamps_valid(stamps):
+    """Check that none of the directories a lookup was based on have changed"""
+    for path, mtime in stamps.items():
+        try:
+            if os.path.getmtime(path) != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def findpybins(start, cachedir=None, names=PYBIN_NAMES):
+    """Resolve the paths to a set of executables for an interpreter or environment in one pass
+
+    Results are kept in memory and, if cachedir is given, in a json file there. Entries are
+    keyed by the path of start and reused until its mtime or that of its bin directory changes.
+    Executables that could not be found map to None.
+    """
+
+    key = os.path.abspath(start)
+    cachefile = os.path.join(cachedir, PYBIN_CACHE) if cachedir else None
+
+    entry = _pybin_memo.get(key)
+    if entry is None and cachefile:
+        entry = read_json(cachefile, {}).get(key)
+    if entry is not None and set(names).issubset(entry['pybins']) and \
+            _pybin_stamps_valid(entry['stamps']):
+        _pybin_memo[key] = entry
+        return entry['pybins']
+
+    # look up everything we've been asked for along with anything seen before
+    names = set(names).union(entry['pybins'] if entry else ())
     try:
-        output = getoutputoserror('brew config')
-        new_start = funcy.re_find(r'HOMEBREW_PREFIX:\s+([/\w]+)', output)
-        if new_start != start:
-            return findpybin(name, new_start)
+        mtime = os.path.getmtime(key)
     except OSError:
-        pass
+        return dict((name, None) for name in names)
+    pybins, stamps = _scan_pybins(_pybin_rootpath(start), sorted(names))
+    stamps[key] = mtime
+    entry = {'stamps': stamps, 'pybins': pybins}
+    _pybin_memo[key] = entry
+
+    if cachefile and os.path.isdir(cachedir):
+        cache = read_json(cachefile, {})
+        cache[key] = entry
+        atomic_write(cachefile, json.dumps(cache, indent=2, sort_keys=True))
+
+    return pybins
+
+
+def findpybin(name, start, cachedir=None):
+    """Find an executable relative to an interpreter or environment, with windows compatibility"""
+    binpath = findpybins(start, cachedir, PYBIN_NAMES + (name,)).get(name)
+    if binpath is None:
+        raise IOError('could not find {0} relative to {1}'.format(name, start))
+    return binpath
+
 
-    raise IOError('could not find {0} relative to {1}'.format(name, start))
+def normalize_name(name):
+    """Normalize a distribution name for comparison, as pip does"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def read_requirements(rtxt):
+    """Return (name, line) pairs for each plain requirement in a requirements file
+
+    Options, includes, urls and editable installs are skipped, since the names they provide
+    can't be known without asking pip
+    """
+
+    ret = []
+    for line in open(rtxt).read().splitlines():
+        line = line.split(' #')[0].strip()
+        if not line or line.startswith(('#', '-')) or '://' in line:
+            continue
+        match = re.match(r'[A-Za-z0-9][A-Za-z0-9._-]*', line)
+        if match:
+            ret.append((normalize_name(match.group(0)), line))
+    return ret
+
+
+def get_site_packages(vdir):
+    """Return the site-packages directories of an environment without walking all of it"""
+    return glob.glob(os.path.join(vdir, 'lib', 'python*', 'site-packages')) + \
+        glob.glob(os.path.join(vdir, 'Lib', 'site-packages'))
+
+
+def installed_names(vdir):
+    """Return the normalized names of all distributions installed into an environment"""
+
+    ret = set()
+    for sitedir in get_site_packages(vdir):
+        for entry in os.listdir(sitedir):
+            base, ext = os.path.splitext(entry)
+            if ext in ('.dist-info', '.egg-info'):
+                ret.add(normalize_name(base.split('-')[0]))
+    return ret
 
 
 @contextmanager
@@ -129,4 +302,5 @@ def str2bool(value):
 
 def get_shell():
     """Get the name of the running shell according to psutil"""
+    import psutil
     return psutil.Process(psutil.Process(os.getpid()).ppid()).name()
@@ -0,0 +1,161 @@
+"""
+fencepy.logs
+
+Log output setup and log file access
+"""
+
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+from logging import handlers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOGFILE = 'fencepy.log'
+FORMATS = ['text', 'json']
+
+# structured fields that fence() attaches to the summary record of each command
+SUMMARY_FIELDS = ('command', 'project', 'elapsed', 'status')
+
+# handlers and listeners installed by start(), so that stop() can undo them
+_installed = []
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line json objects"""
+
+    def format(self, record):
+        data = OrderedDict([
+            ('time', self.formatTime(record)),
+            ('level', record.levelname),
+            ('module', record.module),
+            ('message', record.getMessage())
+        ])
+        for field in SUMMARY_FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class NoSummaryFilter(logging.Filter):
+    """Keep command summary records off the console"""
+
+    def filter(self, record):
+        return not hasattr(record, 'command')
+
+
+def get_logfile(fencepy_root):
+    """Return the path to the log file under the fencepy root"""
+    return os.path.join(fencepy_root, LOGFILE)
+
+
+def _install(handler):
+    """Attach a handler to the root logger and remember it for stop()"""
+    logging.getLogger('').addHandler(handler)
+    _installed.append(handler)
+
+
+def start(args):
+    """Attach the log file and console handlers requested by args to the root logger
+
+    The file handler runs behind a queue where the standard library supports it, so that
+    formatting and writing records never holds up the command itself
+    """
+
+    settings = args['settings']['log']
+    if settings['format'] not in FORMATS:
+        raise ValueError('log format must be one of: {0}'.format(', '.join(FORMATS)))
+
+    if not args['--silent']:
+        if settings['format'] == 'json':
+            f = JsonFormatter()
+        else:
+            f = logging.Formatter('%(asctime)s [%(levelname)s] %(module)s: %(message)s')
+        h = handlers.RotatingFileHandler(
+            get_logfile(args['--fencepy-root']),
+            maxBytes=int(settings['max-bytes']),
+            backupCount=int(settings['backup-count'])
+        )
+        h.setFormatter(f)
+        if hasattr(handlers, 'QueueHandler'):
+            q = queue.Queue(-1)
+            listener = handlers.QueueListener(q, h)
+            listener.start()
+            _installed.append(listener)
+            _install(handlers.QueueHandler(q))
+        else:
+            _install(h)
+
+    if not (args['--silent'] or args['--quiet']):
+        f = logging.Formatter('[%(levelname)s] %(message)s')
+        h = logging.StreamHandler(stream=sys.stderr)
+        h.setFormatter(f)
+        h.addFilter(NoSummaryFilter())
+        _install(h)
+
+    if args['--verbose']:
+        logging.getLogger('').setLevel(logging.DEBUG)
+        logging.getLogger('sh').setLevel(logging.INFO)
+        logging.getLogger('virtualenv').setLevel(logging.INFO)
+    else:
+        logging.getLogger('').setLevel(logging.INFO)
+        logging.getLogger('sh').setLevel(logging.ERROR)
+        logging.getLogger('virtualenv').setLevel(logging.WARNING)
+
+
+def stop():
+    """Flush and detach everything installed by start()"""
+    while _installed:
+        item = _installed.pop()
+        if isinstance(item, logging.Handler):
+            logging.getLogger('').removeHandler(item)
+            item.close()
+        else:
+            item.stop()
+            for h in item.handlers:
+                h.close()
+
+
+def _read_last_lines(filepath, count, blocksize=4096):
+    """Return the last count lines of a file, reading backwards from the end"""
+    with open(filepath, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= count:
+            step = min(blocksize, end)
+            end -= step
+            f.seek(end)
+            data = f.read(step) + data
+    lines = data.decode('utf-8', 'replace').splitlines()
+    return lines[-count:] if count else []
+
+
+def tail(filepath, count, as_json=False):
+    """Return the last count entries of a log file
+
+    If as_json is set, every entry is returned as a json object, wrapping lines that were
+    not written by the json formatter
+    """
+
+    if not os.path.exists(filepath):
+        return []
+    lines = _read_last_lines(filepath, count)
+    if not as_json:
+        return lines
+
+    ret = []
+    for line in lines:
+        try:
+            json.loads(line)
+            ret.append(line)
+        except ValueError:
+            ret.append(json.dumps({'message': line}))
+    return ret
@@ -5,13 +5,26 @@ Main CLI logic
 """
 
 import docopt
+import json
 import os
 import shutil
 import sys
+import tarfile
 import psutil
 import logging
-from logging import handlers
+import time
+from collections import OrderedDict
 from funcy import memoize
+from . import archive
+from . import backends
+from . import dedupe
+from . import doctor
+from . import registry
+from . import resources
+from . import snapshots
+from . import status
+from . import watch
+from . import logs
 from . import plugins
 from . import helpers
 from . import _version
@@ -23,6 +36,9 @@ except ImportError:
 
 l = logging.getLogger(__name__)
 
+# config file sections that hold general settings rather than plugin parameters
+SETTINGS = ['log', 'snapshot', 'limits']
+
 DOCOPT = """
 fencepy -- Standardized fencing off of python virtual environments on a per-project basis
 
@@ -32,7 +48,18 @@ Usage:
   fencepy update [options]
   fencepy erase [options]
   fencepy nuke [options]
+  fencepy list [options]
+  fencepy gc [options]
+  fencepy watch [options]
+  fencepy doctor [options]
+  fencepy snapshot [options]
+  fencepy rollback [options]
+  fencepy export [options]
+  fencepy import [options]
+  fencepy status [options]
+  fencepy dedupe [options]
   fencepy genconfig
+  fencepy log tail [options]
   fencepy help
   fencepy version
 
@@ -42,7 +69,26 @@ Options:
   -s --silent                       Silence ALL output, including log output (except "activate")
   -C FILE --config-file=FILE        Config file to use [default: ~/.fencepy/fencepy.conf]
   -P LIST --plugins=LIST            Comma-separated list of plugins to apply (only "create")
+  -B NAME --backend=NAME            Creation backend: virtualenv, venv [default: virtualenv]
+  -N --no-seed                      Don't install pip into new environments
+  -O --offline                      Install requirements from the local mirror only
   -S DIR --sublime-project-dir=DIR  Search in DIR for .sublime-project files
+  -n N --lines=N                    Number of log entries to show [default: 10]
+  -J --json                         Print json output (only "log tail" and "doctor")
+  -A --all                          Act on every environment (only "doctor" and "update")
+  -R --no-repair                    Report problems without fixing them (only "doctor")
+  -L --list                         List snapshots instead of taking one (only "snapshot")
+  -T NAME --snapshot=NAME           Roll back to snapshot NAME instead of the newest one
+  -o FILE --output=FILE             Write the archive to FILE instead of stdout (only "export")
+  -i FILE --input=FILE              Read the archive from FILE instead of stdin (only "import")
+  --format=FORMAT                   Template for "status", using {name}, {project}, {virtualenv},
+                                    {state}, {active} and {outdated} [default: {name}{outdated}]
+  --budget=MS                       Milliseconds "status" may spend finding the project
+                                    [default: 50]
+  --stale-marker=TEXT               Printed by "status" when it can't answer in time [default: ?]
+  -j N --jobs=N                     Number of jobs to run at once (only "watch" and "dedupe")
+                                    [default: 2]
+  --debounce=SECONDS                Wait for changes to settle (only "watch") [default: 2]
 
 Path Overrides:
   -d DIR --dir=DIR                  Link the fenced environment to DIR instead of the CWD
@@ -53,8 +99,12 @@ Path Overrides:
 
 
 @memoize
-def _get_parsed_config_file(filepath):
-    """Return a SafeConfigParser loaded with the data from a config file at filepath"""
+def _get_parsed_config_file(filepath, stamp=None):
+    """Return a SafeConfigParser loaded with the data from a config file at filepath
+
+    stamp only keys the memo, so that a long-lived process can pass the file's mtime and
+    size to see edits to it
+    """
     ret = SafeConfigParser()
     ret.read(filepath)
     return ret
@@ -90,13 +140,15 @@ def _fill_in_plugins_config(args, config=None):
         args['plugins'][plugin] = _items_to_dict(_get_default_config_parsed().items(plugin))
         args['plugins'][plugin]['enabled'] = False
 
-        # override with anything that comes from the passed in config file
+        # override with anything that comes from the passed in config file, where a section
+        # that only sets other parameters leaves the choice of plugins alone
         if config is not None and config.has_section(plugin):
-            allplugins = False
-            args['plugins'][plugin] = _items_to_dict(config.items(plugin))
-            args['plugins'][plugin]['enabled'] = helpers.str2bool(
-                args['plugins'][plugin]['enabled']
-            )
+            args['plugins'][plugin].update(_items_to_dict(config.items(plugin)))
+            if config.has_option(plugin, 'enabled'):
+                allplugins = False
+                args['plugins'][plugin]['enabled'] = helpers.str2bool(
+                    config.get(plugin, 'enabled')
+                )
 
         # the config file can be overridden by the command line
         if args['--plugins']:
@@ -119,47 +171,69 @@ def _fill_in_plugins_config(args, config=None):
     return args
 
 
+def _fill_in_settings_config(args, config=None):
+    """Add the general (non-plugin) settings structure to args"""
+
+    args['settings'] = {}
+    for section in SETTINGS:
+        args['settings'][section] = _items_to_dict(_get_default_config_parsed().items(section))
+        if config is not None and config.has_section(section):
+            args['settings'][section].update(_items_to_dict(config.items(section)))
+    resources.validate(args['settings']['limits'])
+
+    return args
+
+
 @memoize
 def _get_virtualenv_root(fencepy_root):
     """Return the path to fencepy's virtualenv subdirectory"""
-    return os.path.join(fencepy_root, 'virtualenvs')
+    return registry.get_virtualenv_root(fencepy_root)
 
 
-def _get_args():
-    """Do all parsing and processing for command-line arguments"""
+@memoize
+def _get_default_args():
+    """Return the args that docopt produces when no options are given, and no command"""
+    args = docopt.docopt(DOCOPT, argv=['help'])
+    args['help'] = False
+    return args
 
-    args = docopt.docopt(DOCOPT)
 
-    # set up the root directory
-    args['--fencepy-root'] = os.path.expanduser(args['--fencepy-root'])
-    if not os.path.exists(args['--fencepy-root']):
-        os.mkdir(args['--fencepy-root'])
+def _load_config(args):
+    """Read the config file named in args and fill in the plugins and settings structures"""
 
-    # set up logging
-    if not args['--silent']:
-        f = logging.Formatter('%(asctime)s [%(levelname)s] %(module)s: %(message)s')
-        h = handlers.RotatingFileHandler(os.path.join(args['--fencepy-root'], 'fencepy.log'))
-        h.setFormatter(f)
-        logging.getLogger('').addHandler(h)
-    if not (args['--silent'] or args['--quiet']):
-        f = logging.Formatter('[%(levelname)s] %(message)s')
-        h = logging.StreamHandler(stream=sys.stderr)
-        h.setFormatter(f)
-        logging.getLogger('').addHandler(h)
-
-    if args['--verbose']:
-        logging.getLogger('').setLevel(logging.DEBUG)
-        logging.getLogger('sh').setLevel(logging.INFO)
-    else:
-        logging.getLogger('').setLevel(logging.INFO)
-        logging.getLogger('sh').setLevel(logging.ERROR)
+    # only populate the parser if there's a valid file
+    config = None
+    readconf = True
+    if args['--config-file'] == '~/.fencepy/fencepy.conf':
+        args['--config-file'] = os.path.join(args['--fencepy-root'], 'fencepy.conf')
+        if not os.path.exists(args['--config-file']):
+            readconf = False
+    elif not os.path.exists(args['--config-file']):
+        raise IOError('specified config file {0} does not exist'.format(args['--config-file']))
+    if readconf:
+        st = os.stat(args['--config-file'])
+        config = _get_parsed_config_file(args['--config-file'], (st.st_mtime, st.st_size))
+
+    # fill in the plugins and general settings config
+    _fill_in_plugins_config(args, config)
+    _fill_in_settings_config(args, config)
+
+    return args
+
+
+def _resolve_paths(args):
+    """Work out the project and virtual environment directories, without side effects"""
+
+    args['--fencepy-root'] = os.path.abspath(os.path.expanduser(args['--fencepy-root']))
 
     # we need to do some work to get the root directory we care about here
     if not args['--dir']:
         args['--dir'] = os.getcwd()
     if not args['--no-git']:
         try:
-            output = helpers.getoutputoserror('git rev-parse --show-toplevel')
+            output = helpers.getoutputoserror(
+                ['git', '-C', args['--dir'], 'rev-parse', '--show-toplevel']
+            )
             args['--dir'] = output.strip()
         except OSError:
             l.debug("tried to handle {0} as a git repository, but it isn't one".format(
@@ -168,43 +242,52 @@ def _get_args():
 
     # reset the virtualenv root, if necessary
     if not args['--virtualenv-dir']:
-        venv_root = _get_virtualenv_root(args['--fencepy-root'])
+        args['--virtualenv-dir'] = os.path.join(
+            _get_virtualenv_root(args['--fencepy-root']), registry.env_name(args['--dir'])
+        )
 
-        # if we're one directory below the root, this logic needs to work differently
-        parent = os.path.dirname(args['--dir'])
-        if parent in ('/', os.path.splitdrive(parent)[0]):
-            args['--virtualenv-dir'] = os.path.join(venv_root, os.path.basename(args['--dir']))
+    return args
 
-        else:
-            # need the realpath here because in some circumstances windows paths get passed
-            # with a '/' and others see it coming in as a '\'
-            tokens = os.path.dirname(os.path.realpath(args['--dir'])).split(os.path.sep)
-            tokens.reverse()
-            if tokens[-1] == '':
-                tokens = tokens[:-1]
-            prjpart = '.'.join([os.path.basename(args['--dir']), '.'.join([d[0] for d in tokens])])
-            args['--virtualenv-dir'] = os.path.join(
-                venv_root, '-'.join((prjpart, helpers.pyversionstr()))
-            )
 
-    # only populate the parser if there's a valid file
-    config = None
-    readconf = True
-    if args['--config-file'] == '~/.fencepy/fencepy.conf':
-        args['--config-file'] = os.path.join(args['--fencepy-root'], 'fencepy.conf')
-        if not os.path.exists(args['--config-file']):
-            readconf = False
-    elif not os.path.exists(args['--config-file']):
-        raise IOError('specified config file {0} does not exist'.format(args['--config-file']))
-    if readconf:
-        config = _get_parsed_config_file(args['--config-file'])
+def _get_args(argv=None):
+    """Do all parsing and processing for command-line arguments
 
-    # fill in the plugins config
-    _fill_in_plugins_config(args, config)
+    argv defaults to sys.argv[1:]
+    """
+
+    return _prepare_args(docopt.docopt(DOCOPT, argv=argv))
+
+
+def _prepare_args(args):
+    """Set up the fencepy root, config and logging for parsed args, and resolve paths"""
+
+    # set up the root directory
+    args['--fencepy-root'] = os.path.abspath(os.path.expanduser(args['--fencepy-root']))
+    if not os.path.exists(args['--fencepy-root']):
+        os.mkdir(args['--fencepy-root'])
+
+    _load_config(args)
+
+    # set up logging
+    logs.start(args)
 
+    # remember where this directory's project is, so that "status" doesn't have to ask git
+    dirpath = os.path.abspath(args['--dir'] or os.getcwd())
+    _resolve_paths(args)
+    if not args['--no-git']:
+        status.remember(args['--fencepy-root'], dirpath, args['--dir'])
     return args
 
 
+def _migrate(args):
+    """Move this project's environment over from its legacy name, if it still has one"""
+    fdir = args['--fencepy-root']
+    vdir = args['--virtualenv-dir']
+    venv_root = _get_virtualenv_root(fdir)
+    if vdir == os.path.join(venv_root, registry.env_name(args['--dir'])):
+        registry.migrate(fdir, venv_root, args['--dir'], vdir)
+
+
 def _activate(args):
     """Print out the path to the appropriate activate script"""
 
@@ -241,14 +324,20 @@ def _activate(args):
     return 0
 
 
+def _job_slot(args):
+    """Return a context manager holding one of the host-wide slots for heavy jobs"""
+    return resources.slot(args['--fencepy-root'], int(args['settings']['limits']['jobs']))
+
+
 def _plugins(args):
     """Execute the plugin routines required by command line arguments"""
 
     # plugins
     retval = 0
-    for plugin in plugins.PLUGINS:
-        if plugins.install(plugin, args) == 1:
-            retval = 1
+    with _job_slot(args):
+        for plugin in plugins.PLUGINS:
+            if plugins.install(plugin, args) == 1:
+                retval = 1
 
     return retval
 
@@ -275,19 +364,20 @@ def _create(args):
         os.makedirs(os.path.dirname(vdir))
 
     # go ahead and create the environment
-    virtualenv = helpers.findpybin('virtualenv', sys.executable)
     try:
         l.info('creating {0}'.format(args['--virtualenv-dir']))
-        output = helpers.getoutputoserror(
-            '{0} -p {1} {2}'.format(virtualenv, sys.executable, vdir)
-        )
-        l.debug(''.ljust(40, '='))
-        l.debug(output)
-        l.debug(''.ljust(40, '='))
+        with _job_slot(args):
+            backends.create(args['--backend'], vdir, seed=not args['--no-seed'])
     except OSError as e:
         l.error(str(e))
+        if os.path.exists(vdir):
+            shutil.rmtree(vdir)
         return 1
 
+    # remember what the environment is for
+    registry.write_metadata(vdir, pdir, backend=args['--backend'], seed=not args['--no-seed'])
+    registry.register(args['--fencepy-root'], vdir, pdir)
+
     # finish up with the plugins
     l.info('using plugins: {0}'.format(
         ', '.join([x for x in plugins.PLUGINS if args['plugins'][x]['enabled']])
@@ -295,9 +385,36 @@ def _create(args):
     return _plugins(args)
 
 
+def _registered(args):
+    """Return (virtualenv dir, project dir) pairs for every environment under the fencepy root
+
+    The project is None for environments that aren't in the reverse index
+    """
+    index = registry.load_index(args['--fencepy-root'])
+    venv_root = _get_virtualenv_root(args['--fencepy-root'])
+    envs = dict((vdir, pdir) for vdir, pdir in index.items() if os.path.isdir(vdir))
+    if os.path.exists(venv_root):
+        for name in os.listdir(venv_root):
+            path = os.path.join(venv_root, name)
+            if os.path.isdir(path) and path not in envs:
+                envs[path] = registry.lookup(args['--fencepy-root'], path)
+    return sorted(envs.items())
+
+
 def _update(args):
-    """Just run the plugins again"""
-    return _plugins(args)
+    """Just run the plugins again, for every registered project if asked to"""
+
+    if not args['--all']:
+        return _plugins(args)
+
+    retval = 0
+    for vdir, pdir in _registered(args):
+        if pdir is None or not os.path.isdir(pdir):
+            continue
+        l.info('updating {0}'.format(vdir))
+        if _plugins(dict(args, **{'--virtualenv-dir': vdir, '--dir': pdir})):
+            retval = 1
+    return retval
 
 
 def _erase(args):
@@ -313,6 +430,7 @@ def _erase(args):
 
     # go ahead and create the environment
     shutil.rmtree(vdir)
+    registry.unregister(args['--fencepy-root'], vdir)
     l.info('environment erased successfully')
     return 0
 
@@ -330,10 +448,215 @@ def _nuke(args):
     venv_root = _get_virtualenv_root(args['--fencepy-root'])
     if os.path.exists(venv_root):
         shutil.rmtree(venv_root)
+    if os.path.exists(registry.get_index_file(args['--fencepy-root'])):
+        os.remove(registry.get_index_file(args['--fencepy-root']))
 
     return 0
 
 
+def _doctor(args):
+    """Check environments for problems and repair whatever is broken"""
+
+    vdir = args['--virtualenv-dir']
+    envs = []
+    if args['--all']:
+        envs = [(path, pdir if pdir and os.path.isdir(pdir) else None)
+                for path, pdir in _registered(args)]
+    elif os.path.exists(vdir):
+        envs.append((vdir, args['--dir']))
+    else:
+        l.error('virtual environment does not exist, please execute fencepy create')
+        return 1
+
+    report = doctor.doctor(envs, args, fix=not args['--no-repair'])
+
+    if args['--json']:
+        print(json.dumps(report, indent=2))
+    for entry in report:
+        for name, problem in entry['problems'].items():
+            l.info('{0}: {1}{2}'.format(
+                entry['virtualenv'], problem, ' (repaired)' if entry['repaired'].get(name) else ''
+            ))
+    l.info('{0} of {1} environments healthy'.format(
+        len([x for x in report if x['healthy']]), len(report)
+    ))
+
+    return 0 if all(x['healthy'] for x in report) else 1
+
+
+def _list(args):
+    """Print every environment under the fencepy root along with its project"""
+
+    envs = []
+    for vdir, pdir in _registered(args):
+        envs.append(OrderedDict([
+            ('virtualenv', vdir),
+            ('project', pdir),
+            ('missing', pdir is not None and not os.path.isdir(pdir))
+        ]))
+
+    if args['--json']:
+        print(json.dumps(envs, indent=2))
+    else:
+        for env in envs:
+            print('{0} -> {1}{2}'.format(
+                env['virtualenv'], env['project'] or '?', ' (missing)' if env['missing'] else ''
+            ))
+    return 0
+
+
+def _gc(args):
+    """Remove environments whose projects no longer exist"""
+
+    orphans = [vdir for vdir, pdir in _registered(args)
+               if pdir is not None and not os.path.isdir(pdir)]
+    if not orphans:
+        l.info('no environments to remove')
+        return 0
+
+    # make sure the user really wants to do this
+    for vdir in orphans:
+        print(vdir)
+    answer = input('Remove these {0} environments? [y/N]'.format(len(orphans)))
+    if answer.lower() not in ['y', 'yes']:
+        print('Quitting')
+        return 0
+
+    for vdir in orphans:
+        shutil.rmtree(vdir)
+    registry.unregister(args['--fencepy-root'], *orphans)
+    l.info('removed {0} environments'.format(len(orphans)))
+    return 0
+
+
+def _watch(args):
+    """Update environments whenever their projects' requirements change, until interrupted"""
+
+    def get_targets():
+        return dict((os.path.join(pdir, 'requirements.txt'), (vdir, pdir))
+                    for vdir, pdir in _registered(args) if pdir and os.path.isdir(pdir))
+
+    def update(vdir, pdir):
+        _plugins(dict(args, **{'--virtualenv-dir': vdir, '--dir': pdir}))
+
+    try:
+        watch.watch(get_targets, update, watch.get_watcher(),
+                    indexfile=registry.get_index_file(args['--fencepy-root']),
+                    debounce=float(args['--debounce']), jobs=int(args['--jobs']))
+    except KeyboardInterrupt:
+        l.info('stopped watching')
+    return 0
+
+
+def _snapshot(args):
+    """Take a hardlinked snapshot of the virtualenv, or list the existing ones"""
+
+    vdir = args['--virtualenv-dir']
+    sroot = snapshots.get_snapshot_root(args['--fencepy-root'], vdir)
+
+    if args['--list']:
+        for name in snapshots.list_snapshots(sroot):
+            print(name)
+        return 0
+
+    if not os.path.exists(vdir):
+        l.error('virtual environment does not exist, please execute fencepy create')
+        return 1
+
+    try:
+        name = snapshots.snapshot(vdir, sroot, int(args['settings']['snapshot']['keep']))
+    except ValueError as e:
+        l.error(str(e))
+        return 1
+    l.info('took snapshot {0} of {1}'.format(name, vdir))
+    print(name)
+    return 0
+
+
+def _rollback(args):
+    """Swap the virtualenv for one of its snapshots"""
+
+    vdir = args['--virtualenv-dir']
+    sroot = snapshots.get_snapshot_root(args['--fencepy-root'], vdir)
+    names = snapshots.list_snapshots(sroot)
+
+    name = args['--snapshot'] or (names[-1] if names else None)
+    if name not in names:
+        l.error('no snapshot {0}, choose from: {1}'.format(name or '', ', '.join(names)))
+        return 1
+
+    snapshots.rollback(vdir, os.path.join(sroot, name))
+    l.info('rolled {0} back to snapshot {1}'.format(vdir, name))
+    return 0
+
+
+def _dedupe(args):
+    """Replace files that are identical across environments with hardlinks"""
+
+    vdirs = [vdir for vdir, pdir in _registered(args)]
+    linked, freed = dedupe.dedupe(vdirs, args['--fencepy-root'], int(args['--jobs']))
+    l.info('linked {0} duplicate files across {1} environments, freeing {2} bytes'.format(
+        linked, len(vdirs), freed
+    ))
+    return 0
+
+
+def _export(args):
+    """Stream the virtualenv out as a compressed archive"""
+
+    vdir = args['--virtualenv-dir']
+    if not os.path.exists(vdir):
+        l.error('virtual environment does not exist, please execute fencepy create')
+        return 1
+
+    if args['--output'] and args['--output'] != '-':
+        with open(args['--output'], 'wb') as f:
+            archive.export_env(vdir, f)
+    else:
+        archive.export_env(vdir, getattr(sys.stdout, 'buffer', sys.stdout))
+    l.info('exported {0}'.format(vdir))
+    return 0
+
+
+def _import(args):
+    """Unpack an exported virtualenv for this project, and fix it up for its new location"""
+
+    vdir = args['--virtualenv-dir']
+    pdir = args['--dir']
+    if os.path.exists(vdir):
+        l.error('virtual environment already exists, quitting')
+        return 1
+    if not os.path.exists(os.path.dirname(vdir)):
+        os.makedirs(os.path.dirname(vdir))
+
+    try:
+        if args['--input'] and args['--input'] != '-':
+            with open(args['--input'], 'rb') as f:
+                header = archive.import_env(f, vdir)
+        else:
+            header = archive.import_env(getattr(sys.stdin, 'buffer', sys.stdin), vdir)
+    except (IOError, OSError, tarfile.TarError) as e:
+        l.error(str(e))
+        return 1
+
+    metadata = dict(header['metadata'] or {}, imported_from=header['virtualenv'])
+    metadata.pop('project', None)
+    registry.write_metadata(vdir, pdir, **metadata)
+    registry.register(args['--fencepy-root'], vdir, pdir)
+    l.info('imported {0} from {1}'.format(vdir, header['virtualenv']))
+
+    # the base interpreter may live somewhere else on this machine
+    report = doctor.doctor([(vdir, pdir)], args)
+    for name, problem in report[0]['problems'].items():
+        l.info('{0}{1}'.format(problem, ' (repaired)' if report[0]['repaired'][name] else ''))
+    return 0 if report[0]['healthy'] else 1
+
+
+def _status(args):
+    """Print a short description of this directory's environment, for use in a shell prompt"""
+    return status.run(args)
+
+
 def _genconfig(args):
     """Generate a default config file in the fencepy root directory"""
 
@@ -354,10 +677,33 @@ def _genconfig(args):
     return 0
 
 
-def fence():
-    """Main entry point"""
+def _log(args):
+    """Print out the tail end of the log file"""
+
+    for line in logs.tail(logs.get_logfile(args['--fencepy-root']),
+                          int(args['--lines']), args['--json']):
+        print(line)
+    return 0
+
+
+def fence(argv=None):
+    """Main entry point, taking the command line from argv or sys.argv"""
+
+    args = docopt.docopt(DOCOPT, argv=argv)
 
-    args = _get_args()
+    # prompts run this constantly, so it skips config, logging and git where it can
+    if args['status']:
+        return _status(args)
+
+    args = _prepare_args(args)
+    try:
+        return _fence(args)
+    finally:
+        logs.stop()
+
+
+def _fence(args):
+    """Run the command requested by args"""
 
     # override default help functionality
     if args['help']:
@@ -372,8 +718,24 @@ def fence():
         ))
         return 0
 
+    elif args['log']:
+        return _log(args)
+
     # do a main action
-    for mode in ['activate', 'create', 'update', 'erase', 'nuke', 'genconfig']:
+    for mode in ['activate', 'create', 'update', 'erase', 'nuke', 'list', 'gc', 'watch',
+                 'doctor', 'snapshot', 'rollback', 'export', 'import', 'dedupe',
+                 'genconfig']:
         if args[mode]:
+            if mode not in ('nuke', 'genconfig'):
+                _migrate(args)
             l.debug('{0}ing environment with args: {1}'.format(mode[:-1], args))
-            return globals()['_{0}'.format(mode)](args)
+            start = time.time()
+            ret = globals()['_{0}'.format(mode)](args)
+            elapsed = time.time() - start
+            l.info('{0} finished with status {1} in {2:.3f}s'.format(mode, ret, elapsed), extra={
+                'command': mode,
+                'project': args['--dir'],
+                'elapsed': round(elapsed, 3),
+                'status': ret
+            })
+            return ret
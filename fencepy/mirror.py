@@ -0,0 +1,120 @@
+"""
+fencepy.mirror
+
+A local simple-index mirror of the packages fencepy has installed, so that environments can
+be created again without a network
+"""
+
+import hashlib
+import json
+import os
+from six.moves.urllib.parse import urljoin
+from . import helpers
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('.whl', '.tar.gz', '.tar.bz2', '.zip')
+HASH_CACHE = 'hashes.json'
+
+PAGE = '''<!DOCTYPE html>
+<html>
+  <head><title>{0}</title></head>
+  <body>
+{1}
+  </body>
+</html>
+'''
+
+
+def get_mirror_dir(fencepy_root):
+    """Return the path to the mirror under the fencepy root"""
+    return os.path.join(fencepy_root, 'mirror')
+
+
+def get_files_dir(mirror_dir):
+    """Return the directory that downloaded archives are kept in"""
+    return os.path.join(mirror_dir, 'files')
+
+
+def get_index_url(mirror_dir):
+    """Return a url that pip can use as --index-url for the mirror"""
+
+    # urllib.request pulls in http, ssl and email, which most commands never need
+    from six.moves.urllib.request import pathname2url
+    simple_dir = os.path.join(os.path.abspath(mirror_dir), 'simple')
+    return urljoin('file:', pathname2url(simple_dir)) + '/'
+
+
+def project_name(filename):
+    """Return the normalized project name of a wheel or sdist filename, or None"""
+    if filename.endswith('.whl'):
+        return helpers.normalize_name(filename.split('-')[0])
+    for ext in ARCHIVE_EXTENSIONS:
+        if filename.endswith(ext):
+            base = filename[:-len(ext)]
+            for i, char in enumerate(base):
+                if char == '-' and base[i + 1:i + 2].isdigit():
+                    return helpers.normalize_name(base[:i])
+    return None
+
+
+def has_packages(mirror_dir):
+    """Return whether anything has been mirrored yet"""
+    files_dir = get_files_dir(mirror_dir)
+    return os.path.isdir(files_dir) and any(project_name(x) for x in os.listdir(files_dir))
+
+
+def _sha256(filepath):
+    """Return the sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_if_changed(filepath, text):
+    """Write text to filepath, unless that's what it already holds"""
+    if os.path.exists(filepath) and open(filepath).read() == text:
+        return
+    helpers.atomic_write(filepath, text)
+
+
+def rebuild_index(mirror_dir):
+    """Regenerate the PEP 503 pages for everything in the mirror's files directory
+
+    File hashes are cached by name and size, so only new archives are read, and pages are
+    only written when their content changes
+    """
+
+    files_dir = get_files_dir(mirror_dir)
+    simple_dir = os.path.join(mirror_dir, 'simple')
+    if not os.path.exists(simple_dir):
+        os.makedirs(simple_dir)
+
+    hashfile = os.path.join(mirror_dir, HASH_CACHE)
+    hashes = helpers.read_json(hashfile, {})
+    projects = {}
+    for filename in sorted(os.listdir(files_dir)):
+        name = project_name(filename)
+        if name is None:
+            continue
+        filepath = os.path.join(files_dir, filename)
+        key = '{0}:{1}'.format(filename, os.path.getsize(filepath))
+        if key not in hashes:
+            hashes[key] = _sha256(filepath)
+        projects.setdefault(name, []).append((filename, hashes[key]))
+
+    for name, files in projects.items():
+        project_dir = os.path.join(simple_dir, name)
+        if not os.path.exists(project_dir):
+            os.mkdir(project_dir)
+        links = '\n'.join('    <a href="../../files/{0}#sha256={1}">{0}</a><br/>'.format(*x)
+                          for x in files)
+        _write_if_changed(os.path.join(project_dir, 'index.html'), PAGE.format(name, links))
+
+    links = '\n'.join('    <a href="{0}/">{0}</a><br/>'.format(name) for name in sorted(projects))
+    _write_if_changed(os.path.join(simple_dir, 'index.html'), PAGE.format('Simple', links))
+    _write_if_changed(hashfile, json.dumps(hashes, indent=2, sort_keys=True))
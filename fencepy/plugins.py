@@ -6,9 +6,13 @@ Plugins for use during environment creation
 
 import json
 import os
+from collections import OrderedDict
 import sys
 import textwrap
 from . import helpers
+from . import mirror
+from . import registry
+from . import status
 
 # set up logging
 import logging
@@ -17,31 +21,129 @@ l = logging.getLogger(__name__)
 PLUGINS = ['requirements', 'sublime', 'ps1', 'shellfuncs']
 
 
+def pip_command(vdir, fdir):
+    """Return the command to run pip against an environment
+
+    Environments created without seeding are driven by the pip that fencepy runs under
+    """
+    pybins = helpers.findpybins(vdir, fdir)
+    if pybins['pip']:
+        return [pybins['pip']]
+    return [sys.executable, '-m', 'pip', '--python', helpers.findpybin('python', vdir, fdir)]
+
+
+def _use_mirror_only(args):
+    """Decide whether requirements must come from the local mirror alone"""
+    offline = args['plugins']['requirements']['offline']
+    return bool(args['--offline']) or (offline != 'auto' and helpers.str2bool(offline))
+
+
+def _can_fall_back(args, mirror_dir):
+    """Decide whether requirements that pip couldn't get may come from the local mirror
+
+    This is left to pip failing, rather than probing the network, so that proxies and
+    indexes from pip's own configuration are respected
+    """
+    return args['plugins']['requirements']['offline'] == 'auto' and \
+        mirror.has_packages(mirror_dir)
+
+
 def _install_requirements(args):
-    """Install requirements out of requirements.txt, if it exists"""
+    """Install requirements out of requirements.txt, if it exists
+
+    Unless disabled, packages are downloaded into the local mirror first and installed
+    from there, so that the same requirements can later be installed without a network.
+    Requirements that were installed from the mirror last time, and haven't changed since,
+    are installed from it straight away. If installing from the mirror fails (it doesn't
+    hold build dependencies, for one), pip is left to get the requirements itself.
+    """
 
     # break out various args for convenience
     vdir = args['--virtualenv-dir']
     pdir = args['--dir']
+    fdir = args['--fencepy-root']
+    mdir = mirror.get_mirror_dir(fdir)
+    limits = args['settings']['limits']
 
     # install requirements, if they exist
     rtxt = os.path.join(pdir, 'requirements.txt')
     if os.path.exists(rtxt):
         l.info('loading requirements from {0}'.format(rtxt))
+        current = status.fingerprint(rtxt)
+        metadata = registry.read_metadata(vdir) or {}
         try:
-            output = helpers.getoutputoserror(
-                '{0} install -r {1}'.format(helpers.findpybin('pip', vdir), rtxt)
-            )
+            pip = pip_command(vdir, fdir)
+            install = pip + ['install', '-r', rtxt]
+            mirrored = install + ['--no-index', '--find-links', mirror.get_files_dir(mdir)]
+            offline = install + ['--index-url', mirror.get_index_url(mdir)]
+
+            # (description, command, whether it installs from the mirror) in order of preference
+            attempts = []
+            if _use_mirror_only(args):
+                attempts.append(('the local mirror', offline, True))
+
+            elif helpers.str2bool(args['plugins']['requirements']['mirror']):
+                if metadata.get('mirrored') is not None and metadata['mirrored'] == current:
+                    l.debug('requirements are unchanged, installing them from the local mirror')
+                    attempts.append(('the local mirror', mirrored, True))
+                else:
+                    try:
+                        output = helpers.getoutputoserror(
+                            pip + ['download', '-r', rtxt, '-d', mirror.get_files_dir(mdir)],
+                            limits
+                        )
+                        l.debug(output)
+                        mirror.rebuild_index(mdir)
+                        attempts.append(('the local mirror', mirrored, True))
+                    except OSError as e:
+                        l.warning('could not mirror requirements, installing directly')
+                        l.debug(str(e))
+
+            if not _use_mirror_only(args):
+                attempts.append(('the package index', install, False))
+                if _can_fall_back(args, mdir):
+                    attempts.append(('the local mirror only', offline, True))
+
+            for i, (description, command, from_mirror) in enumerate(attempts):
+                try:
+                    output = helpers.getoutputoserror(command, limits)
+                    break
+                except OSError as e:
+                    if i == len(attempts) - 1:
+                        raise
+                    l.debug(str(e))
+                    l.warning('could not install requirements from {0}, trying {1}'.format(
+                        description, attempts[i + 1][0]
+                    ))
             l.debug(''.ljust(40, '='))
             l.debug(output)
             l.debug(''.ljust(40, '='))
         except OSError as e:
             l.error(str(e))
             return 1
+
+        # only write when something changed, so that a no-op update leaves the environment be
+        recorded = {'requirements': current, 'mirrored': current if from_mirror else None}
+        if any(metadata.get(k) != v for k, v in recorded.items()):
+            registry.update_metadata(vdir, **recorded)
         l.info('finished installing requirements')
         return 0
 
 
+def _find_sublime_projects(pdir, sdir):
+    """Return the paths to all sublime project files that belong to a project"""
+
+    # first, check the sublime project directory (if supplied)
+    if sdir:
+        guess = os.path.join(sdir, '{0}.sublime-project'.format(os.path.basename(pdir)))
+        if os.path.exists(guess):
+            return [guess]
+
+    # try the local directory
+    return [os.path.join(pdir, filename) for filename in sorted(os.listdir(pdir))
+            if filename.endswith('.sublime-project')]
+
+
 def _install_sublime(args):
     """Set up sublime linter to use environment"""
 
@@ -49,48 +151,38 @@ def _install_sublime(args):
     vdir = args['--virtualenv-dir']
     pdir = args['--dir']
     sdir = args['plugins']['sublime']['project-dir']
+    fdir = args['--fencepy-root']
 
     # set up the sublime linter, if appropriate
-    scfg = None
+    scfgs = _find_sublime_projects(pdir, sdir)
+    if not scfgs:
+        return 0
 
-    # first, check the sublime project directory (if supplied)
-    if sdir:
-        guess = os.path.join(sdir, '{0}.sublime-project'.format(os.path.basename(pdir)))
-        if os.path.exists(guess):
-            scfg = guess
+    dict_data = {
+        'SublimeLinter': {
+            'paths': {'linux': [os.path.join(vdir, helpers.getpybindir())]},
+            'python_paths': {'linux': helpers.locate_subdirs('site-packages', vdir)}
+        },
+        'settings': {'python_interpreter': helpers.findpybin('python', vdir, fdir)}
+    }
 
-    # try the local directory
-    if not scfg:
-        for filename in os.listdir(pdir):
-            if filename.endswith('.sublime-project'):
-                scfg = os.path.join(pdir, filename)
-                break
-
-    # if we found a file, go to work
-    if scfg:
+    # only touch files whose effective content would change, keeping their key order
+    for scfg in scfgs:
+        with open(scfg) as f:
+            cfg_dict = json.load(f, object_pairs_hook=OrderedDict)
+        if not helpers.pseudo_merge_dict(cfg_dict, dict_data):
+            l.debug('sublime linter in file {0} is already configured'.format(scfg))
+            continue
         l.debug('configuring sublime linter in file {0}'.format(scfg))
-        cfg_dict = json.load(open(scfg))
-        dict_data = {
-            'SublimeLinter': {
-                'paths': {'linux': [os.path.join(vdir, helpers.getpybindir())]},
-                'python_paths': {'linux': helpers.locate_subdirs('site-packages', vdir)}
-            },
-            'settings': {'python_interpreter': helpers.findpybin('python', vdir)}
-        }
-        helpers.pseudo_merge_dict(cfg_dict, dict_data)
-        json.dump(cfg_dict, open(scfg, 'w'), indent=4, separators=(', ', ': '), sort_keys=True)
-        l.info('successfully configured sublime linter')
+        helpers.atomic_write(scfg, json.dumps(cfg_dict, indent=4, separators=(',', ': ')))
+        l.info('successfully configured sublime linter in {0}'.format(scfg))
 
     return 0
 
 
-def _install_ps1(args):
-    """Change the PS1 environment name in activate scripts"""
-
-    ps1str = '-'.join((os.path.basename(args['--dir']), helpers.pyversionstr()))
-    vdir = args['--virtualenv-dir']
-
-    mods = {
+def get_ps1_mods(vdir, ps1str):
+    """Return the edits that the ps1 plugin makes to each activate script"""
+    return {
         'activate': {
             'from': '`basename \\"$VIRTUAL_ENV\\"`',
             'to': ps1str
@@ -112,7 +204,16 @@ def _install_ps1(args):
             'to': ps1str
         }
     }
-    subdirs = ('bin', 'Scrips')
+
+
+def _install_ps1(args):
+    """Change the PS1 environment name in activate scripts"""
+
+    ps1str = '-'.join((os.path.basename(args['--dir']), helpers.pyversionstr()))
+    vdir = args['--virtualenv-dir']
+
+    mods = get_ps1_mods(vdir, ps1str)
+    subdirs = ('bin', 'Scripts')
 
     for filename, trans in mods.items():
         for subdir in subdirs:
@@ -129,7 +230,7 @@ def _install_ps1(args):
                     else:
                         text = text.replace(trans['from'], trans['to'])
 
-                    open(filepath, 'w').write(text)
+                    helpers.atomic_write(filepath, text)
 
     return 0
 
@@ -138,17 +239,20 @@ def _install_shellfuncs(args):
     """Set up some functions for zsh users"""
 
     # for oh-my-zsh users
-    target_file = '~/.oh-my-zsh/custom/fencepy.zsh'
-    if os.path.exists(os.path.expanduser(os.path.dirname(target_file))):
+    target_file = os.path.expanduser('~/.oh-my-zsh/custom/fencepy.zsh')
+    text = textwrap.dedent(
+        '''fpadd() { fencepy create }
+        fpnew() { fencepy create }
+        fpsrc() { source `fencepy activate` }
+        fpup() { fencepy update }
+        fpdel() { fencepy erase }
+        '''
+    )
+    if os.path.exists(os.path.dirname(target_file)):
+        if os.path.exists(target_file) and open(target_file).read() == text:
+            return 0
         l.info('(re)configuring oh-my-zsh functions')
-        open(os.path.expanduser(target_file), 'w').write(textwrap.dedent(
-            '''fpadd() { fencepy create }
-            fpnew() { fencepy create }
-            fpsrc() { source `fencepy activate` }
-            fpup() { fencepy update }
-            fpdel() { fencepy erase }
-            '''
-        ))
+        open(target_file, 'w').write(text)
 
     return 0
 
@@ -0,0 +1,185 @@
+"""
+fencepy.registry
+
+Environment naming, per-environment metadata and the reverse index under the fencepy root
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sys
+from . import helpers
+from . import snapshots
+from . import _version
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+METADATA = 'fencepy.json'
+INDEX = 'index.json'
+
+
+def _project_key(pdir):
+    """Return the canonical form of a project path, which is what names are derived from"""
+    return os.path.normcase(os.path.realpath(pdir))
+
+
+def env_name(pdir):
+    """Return the environment name for a project
+
+    The name is the project's basename, for readability, followed by a short hash of its
+    real path, which keeps projects with similar paths apart
+    """
+    key = _project_key(pdir)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return '-'.join((os.path.basename(key) or 'root', digest, helpers.pyversionstr()))
+
+
+def legacy_name(pdir):
+    """Return the environment name that fencepy used for a project before hashed names"""
+
+    # if we're one directory below the root, this logic needs to work differently
+    parent = os.path.dirname(pdir)
+    if parent in ('/', os.path.splitdrive(parent)[0]):
+        return os.path.basename(pdir)
+
+    # need the realpath here because in some circumstances windows paths get passed
+    # with a '/' and others see it coming in as a '\'
+    tokens = os.path.dirname(os.path.realpath(pdir)).split(os.path.sep)
+    tokens.reverse()
+    if tokens[-1] == '':
+        tokens = tokens[:-1]
+    prjpart = '.'.join([os.path.basename(pdir), '.'.join([d[0] for d in tokens])])
+    return '-'.join((prjpart, helpers.pyversionstr()))
+
+
+def get_virtualenv_root(fencepy_root):
+    """Return the path to fencepy's virtualenv subdirectory"""
+    return os.path.join(fencepy_root, 'virtualenvs')
+
+
+def read_metadata(vdir):
+    """Return the metadata recorded in an environment, or None if there is none"""
+    return helpers.read_json(os.path.join(vdir, METADATA))
+
+
+def write_metadata(vdir, pdir, **params):
+    """Record the project, interpreter and creation parameters of an environment"""
+    data = dict(params, **{
+        'project': pdir,
+        'interpreter': sys.executable,
+        'python': helpers.pyversionstr(),
+        'fencepy': _version.__version__,
+        'created': datetime.datetime.now().isoformat()
+    })
+    helpers.atomic_write(os.path.join(vdir, METADATA), json.dumps(data, indent=2, sort_keys=True))
+    return data
+
+
+def update_metadata(vdir, **params):
+    """Merge params into the metadata already recorded in an environment"""
+    data = dict(read_metadata(vdir) or {}, **params)
+    helpers.atomic_write(os.path.join(vdir, METADATA), json.dumps(data, indent=2, sort_keys=True))
+    return data
+
+
+def get_index_file(fencepy_root):
+    """Return the path to the reverse index under the fencepy root"""
+    return os.path.join(fencepy_root, INDEX)
+
+
+def load_index(fencepy_root):
+    """Return the reverse index, a dict of environment path -> project path"""
+    return helpers.read_json(get_index_file(fencepy_root), {})
+
+
+def _save_index(fencepy_root, index):
+    """Write the reverse index"""
+    if not os.path.exists(fencepy_root):
+        os.makedirs(fencepy_root)
+    helpers.atomic_write(get_index_file(fencepy_root), json.dumps(index, indent=2, sort_keys=True))
+
+
+def register(fencepy_root, vdir, pdir):
+    """Add an environment to the reverse index"""
+    index = load_index(fencepy_root)
+    index[os.path.abspath(vdir)] = pdir
+    _save_index(fencepy_root, index)
+
+
+def unregister(fencepy_root, *vdirs):
+    """Remove environments from the reverse index"""
+    index = load_index(fencepy_root)
+    for vdir in vdirs:
+        index.pop(os.path.abspath(vdir), None)
+    _save_index(fencepy_root, index)
+
+
+def lookup(fencepy_root, vdir):
+    """Return the project an environment belongs to, or None if it is unknown"""
+    pdir = load_index(fencepy_root).get(os.path.abspath(vdir))
+    if pdir is None:
+        pdir = (read_metadata(vdir) or {}).get('project')
+    return pdir
+
+
+def relocate(vdir, old, new):
+    """Rewrite references to an environment's old location in its scripts
+
+    Only text files in the bin (or Scripts) directory and pyvenv.cfg contain absolute paths
+    to the environment itself. Returns the number of files rewritten.
+    """
+
+    candidates = [os.path.join(vdir, 'pyvenv.cfg')]
+    for subdir in ('bin', 'Scripts'):
+        bindir = os.path.join(vdir, subdir)
+        if os.path.isdir(bindir):
+            candidates.extend(os.path.join(bindir, x) for x in os.listdir(bindir))
+
+    count = 0
+    for filepath in candidates:
+        if os.path.islink(filepath) or not os.path.isfile(filepath):
+            continue
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        if b'\0' in data or old.encode('utf-8') not in data:
+            continue
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        helpers.atomic_write(filepath, text.replace(old, new))
+        count += 1
+    return count
+
+
+def migrate(fencepy_root, venv_root, pdir, vdir):
+    """Move a project's environment from its legacy name to vdir, if there is one
+
+    Returns True if an environment was migrated
+    """
+
+    old = os.path.join(venv_root, legacy_name(pdir))
+    if os.path.normcase(old) == os.path.normcase(vdir) or \
+            not os.path.isdir(old) or os.path.exists(vdir):
+        return False
+
+    l.info('migrating {0} to {1}'.format(old, vdir))
+    os.rename(old, vdir)
+    relocate(vdir, old, vdir)
+    if read_metadata(vdir) is None:
+        write_metadata(vdir, pdir, migrated_from=old)
+
+    # snapshots are keyed by environment name, and contain the same absolute paths
+    old_snapshots = snapshots.get_snapshot_root(fencepy_root, old)
+    if os.path.isdir(old_snapshots):
+        new_snapshots = snapshots.get_snapshot_root(fencepy_root, vdir)
+        os.rename(old_snapshots, new_snapshots)
+        for name in snapshots.list_snapshots(new_snapshots):
+            relocate(os.path.join(new_snapshots, name), old, vdir)
+
+    unregister(fencepy_root, old)
+    register(fencepy_root, vdir, pdir)
+    return True
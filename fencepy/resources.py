@@ -0,0 +1,155 @@
+"""
+fencepy.resources
+
+Keep heavy create and update jobs out of the way of other work on the host: lower priority
+for subprocesses, limited build parallelism, and a host-wide limit on concurrent jobs
+"""
+
+import os
+import platform
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# psutil constants for each io scheduling class, on linux and windows respectively
+IONICE_CLASSES = {
+    'idle': ('IOPRIO_CLASS_IDLE', 'IOPRIO_VERYLOW'),
+    'best-effort': ('IOPRIO_CLASS_BE', 'IOPRIO_NORMAL')
+}
+
+# environment variables that build systems take their parallelism from
+BUILD_JOBS_VARIABLES = {
+    'MAKEFLAGS': '-j{0}',
+    'CMAKE_BUILD_PARALLEL_LEVEL': '{0}',
+    'NPY_NUM_BUILD_JOBS': '{0}'
+}
+
+
+def validate(limits):
+    """Raise ValueError if the [limits] settings don't make sense"""
+    for name in ('nice', 'jobs', 'build-jobs'):
+        try:
+            value = int(limits.get(name) or 0)
+        except ValueError:
+            value = -1
+        if value < 0 or (name == 'nice' and value > 19):
+            raise ValueError('limits {0} must be a whole number{1}, not {2}'.format(
+                name, ' from 0 to 19' if name == 'nice' else ' of 0 or more', limits[name]
+            ))
+    if limits.get('ionice') and limits['ionice'] not in IONICE_CLASSES:
+        raise ValueError('limits ionice must be empty or one of: {0}'.format(
+            ', '.join(sorted(IONICE_CLASSES))
+        ))
+
+
+def get_environ(limits):
+    """Return the environment for subprocesses under the [limits] settings, or None to
+    inherit fencepy's own"""
+    jobs = int(limits.get('build-jobs') or 0)
+    if jobs <= 0:
+        return None
+    return dict(os.environ, **dict((k, v.format(jobs)) for k, v in BUILD_JOBS_VARIABLES.items()))
+
+
+def lower_priority(pid, limits):
+    """Apply the niceness and io scheduling class from the [limits] settings to a process
+
+    Children the process starts afterwards inherit both. Priority is only ever lowered,
+    and anything the platform doesn't support is skipped.
+    """
+
+    # psutil is slow to import, and only needed once a subprocess actually runs
+    import psutil
+    nice = int(limits.get('nice') or 0)
+    ionice = limits.get('ionice')
+    try:
+        proc = psutil.Process(pid)
+        if nice > 0:
+            if platform.system() == 'Windows':
+                proc.nice(psutil.IDLE_PRIORITY_CLASS if nice >= 15
+                          else psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            else:
+                proc.nice(max(proc.nice(), nice))
+        if ionice:
+            names = [x for x in IONICE_CLASSES[ionice] if hasattr(psutil, x)]
+            if names and hasattr(proc, 'ionice'):
+                proc.ionice(getattr(psutil, names[0]))
+            else:
+                l.debug('io scheduling classes are not supported here')
+    except (psutil.Error, OSError) as e:
+        l.debug('could not lower the priority of process {0}: {1}'.format(pid, e))
+
+
+def get_lock_dir(fencepy_root):
+    """Return the directory holding the job slot lock files under the fencepy root"""
+    return os.path.join(fencepy_root, 'locks')
+
+
+def _try_lock(f):
+    """Take an exclusive lock on an open file without waiting, returning whether it worked"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _unlock(f):
+    """Release a lock taken by _try_lock"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def slot(fencepy_root, jobs, poll=0.5):
+    """Hold one of jobs host-wide job slots for the duration, waiting for one to come free
+
+    Each slot is a lock file under the fencepy root, so a slot held by a process that dies
+    is released by the operating system. If jobs is 0 or less, there is no limit.
+    """
+
+    if jobs <= 0:
+        yield None
+        return
+
+    lockdir = get_lock_dir(fencepy_root)
+    if not os.path.isdir(lockdir):
+        try:
+            os.makedirs(lockdir)
+        except OSError:
+            if not os.path.isdir(lockdir):
+                raise
+
+    waiting = False
+    while True:
+        for i in range(jobs):
+            f = open(os.path.join(lockdir, 'slot-{0}'.format(i)), 'a+')
+            if not _try_lock(f):
+                f.close()
+                continue
+            try:
+                yield i
+            finally:
+                _unlock(f)
+                f.close()
+            return
+        if not waiting:
+            l.info('waiting for one of {0} job slots to come free'.format(jobs))
+            waiting = True
+        time.sleep(poll)
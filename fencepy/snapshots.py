@@ -0,0 +1,155 @@
+"""
+fencepy.snapshots
+
+Cheap point-in-time copies of environments, made of hardlinks, and rollback to them
+"""
+
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import fnmatch
+import hashlib
+import os
+import platform
+import shutil
+import sys
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# files that are edited in place (by fencepy plugins, or by setuptools for .pth files)
+# get real copies, so that changes to a live environment can never leak into a snapshot
+COPY_PATTERNS = ('activate*', 'pyvenv.cfg', '*.pth')
+
+# arguments to the linux renameat2 call for swapping two paths
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+def get_snapshot_root(fencepy_root, vdir):
+    """Return the directory holding all snapshots of an environment
+
+    The directory is named after the environment, plus a short hash of its full path, since
+    environments given with --virtualenv-dir can easily share a name
+    """
+    path = os.path.normcase(os.path.abspath(vdir))
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(fencepy_root, 'snapshots',
+                        '{0}-{1}'.format(os.path.basename(path), digest))
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a copy where hardlinks aren't possible"""
+    if not any(fnmatch.fnmatch(os.path.basename(src), x) for x in COPY_PATTERNS):
+        try:
+            os.link(src, dst)
+            return
+        except (OSError, AttributeError):
+            pass
+    shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    """Recreate the tree at src under dst, hardlinking files and copying symlinks as-is"""
+    for path, dirs, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(path, src)))
+        os.makedirs(target)
+        shutil.copystat(path, target)
+        for name in dirs + files:
+            srcpath = os.path.join(path, name)
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), os.path.join(target, name))
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in files:
+                _link_or_copy(srcpath, os.path.join(target, name))
+
+
+def list_snapshots(snapshot_root):
+    """Return the names of all snapshots in snapshot_root, oldest first"""
+    if not os.path.exists(snapshot_root):
+        return []
+    return sorted(x for x in os.listdir(snapshot_root) if not x.startswith('.'))
+
+
+def prune(snapshot_root, keep):
+    """Remove all but the newest keep snapshots, returning the names removed"""
+    if keep < 1:
+        raise ValueError('the number of snapshots to keep must be at least 1')
+    names = list_snapshots(snapshot_root)
+    removed = names[:max(len(names) - keep, 0)]
+    for name in removed:
+        shutil.rmtree(os.path.join(snapshot_root, name))
+    return removed
+
+
+def snapshot(vdir, snapshot_root, keep):
+    """Take a snapshot of vdir and apply the retention limit, returning the snapshot's name
+
+    The snapshot is built under a hidden name and renamed into place, so a partial snapshot
+    is never visible
+    """
+
+    if keep < 1:
+        raise ValueError('the number of snapshots to keep must be at least 1')
+
+    name = datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    staging = os.path.join(snapshot_root, '.{0}'.format(name))
+    if not os.path.exists(snapshot_root):
+        os.makedirs(snapshot_root)
+    try:
+        link_tree(vdir, staging)
+        os.rename(staging, os.path.join(snapshot_root, name))
+    finally:
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+
+    for removed in prune(snapshot_root, keep):
+        l.info('removed old snapshot {0}'.format(removed))
+    return name
+
+
+def exchange(first, second):
+    """Atomically swap two paths, returning False if the platform or filesystem can't"""
+
+    if platform.system() != 'Linux':
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'renameat2'):
+        return False
+
+    paths = [x if isinstance(x, bytes) else x.encode(sys.getfilesystemencoding())
+             for x in (first, second)]
+    if libc.renameat2(AT_FDCWD, paths[0], AT_FDCWD, paths[1], RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL):
+        return False
+    raise OSError(error, os.strerror(error), first)
+
+
+def rollback(vdir, snapshot_path):
+    """Replace vdir with the contents of a snapshot
+
+    The restored tree is fully built next to vdir before the two are swapped. On linux the
+    swap is a single atomic exchange; elsewhere it takes two renames, so the environment is
+    briefly absent, but it is never half restored
+    """
+
+    staging = '{0}.rollback'.format(vdir)
+    retired = '{0}.retired'.format(vdir)
+    for leftover in (staging, retired):
+        if os.path.exists(leftover):
+            shutil.rmtree(leftover)
+
+    link_tree(snapshot_path, staging)
+    if os.path.exists(vdir) and exchange(staging, vdir):
+        shutil.rmtree(staging)
+        return
+    if os.path.exists(vdir):
+        os.rename(vdir, retired)
+    os.rename(staging, vdir)
+    if os.path.exists(retired):
+        shutil.rmtree(retired)
@@ -0,0 +1,222 @@
+"""
+fencepy.status
+
+Cheap answers about the current directory's environment, for shell prompts
+"""
+
+import docopt
+import hashlib
+import json
+import os
+import subprocess
+import time
+from . import helpers
+from . import registry
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# directory -> project mapping under the fencepy root, and the most directories it holds
+CACHE = 'status.json'
+CACHE_SIZE = 500
+
+STATES = ('active', 'inactive', 'missing', 'stale')
+
+# the part of fencepy.main's usage that applies to status; the full usage takes far longer
+# to parse than a prompt can wait, and importing fencepy.main takes longer still
+DOCOPT = """
+Usage:
+  fencepy status [options]
+
+Options:
+  -v --verbose
+  -q --quiet
+  -s --silent
+  -C FILE --config-file=FILE        [default: ~/.fencepy/fencepy.conf]
+  --format=FORMAT                   [default: {name}{outdated}]
+  --budget=MS                       [default: 50]
+  --stale-marker=TEXT               [default: ?]
+  -d DIR --dir=DIR
+  -D DIR --virtualenv-dir=DIR
+  -F DIR --fencepy-root=DIR         [default: ~/.fencepy]
+  -G --no-git
+"""
+
+
+def get_cache_file(fencepy_root):
+    """Return the path to the resolution cache under the fencepy root"""
+    return os.path.join(fencepy_root, CACHE)
+
+
+def _find_git(dirpath):
+    """Return the nearest of dirpath and its parents that holds a .git, or None"""
+    while True:
+        if os.path.exists(os.path.join(dirpath, '.git')):
+            return dirpath
+        parent = os.path.dirname(dirpath)
+        if parent == dirpath:
+            return None
+        dirpath = parent
+
+
+def recall(fencepy_root, dirpath):
+    """Return the project remembered for dirpath, or None if there isn't one
+
+    An entry is only trusted while the repository it was found in is still the nearest one
+    to dirpath, and the project still exists
+    """
+    entry = helpers.read_json(get_cache_file(fencepy_root), {}).get(dirpath)
+    if not isinstance(entry, list) or _find_git(dirpath) != entry[1] or \
+            not os.path.isdir(entry[0]):
+        return None
+    return entry[0]
+
+
+def remember(fencepy_root, dirpath, pdir):
+    """Record that dirpath belongs to the project pdir, writing only if that's news
+
+    Directories that no longer exist are dropped, along with the oldest entries once there
+    are more than CACHE_SIZE
+    """
+    if not os.path.isdir(fencepy_root):
+        return
+    cachefile = get_cache_file(fencepy_root)
+    cache = helpers.read_json(cachefile, {})
+    gitdir = _find_git(dirpath)
+    entry = cache.get(dirpath)
+    if isinstance(entry, list) and entry[:2] == [pdir, gitdir]:
+        return
+    cache = dict((k, v) for k, v in cache.items() if isinstance(v, list) and os.path.isdir(k))
+    cache[dirpath] = [pdir, gitdir, time.time()]
+    for key in sorted(cache, key=lambda x: cache[x][2])[:-CACHE_SIZE]:
+        del cache[key]
+    helpers.atomic_write(cachefile, json.dumps(cache, indent=2, sort_keys=True))
+
+
+def fingerprint(filepath):
+    """Return the mtime, size and sha1 of a file, or None if it doesn't exist"""
+    try:
+        st = os.stat(filepath)
+        with open(filepath, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+    return {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': digest}
+
+
+def requirements_changed(vdir, pdir):
+    """Return whether requirements.txt differs from what was last installed into vdir
+
+    The file is only read when its mtime or size no longer match the recorded fingerprint
+    """
+
+    recorded = (registry.read_metadata(vdir) or {}).get('requirements')
+    rtxt = os.path.join(pdir, 'requirements.txt')
+    try:
+        st = os.stat(rtxt)
+    except OSError:
+        return False
+    if recorded is None:
+        return True
+    if (st.st_mtime, st.st_size) == (recorded['mtime'], recorded['size']):
+        return False
+    return (fingerprint(rtxt) or {}).get('sha1') != recorded['sha1']
+
+
+def _git_toplevel(dirpath, deadline):
+    """Return the git toplevel of dirpath, dirpath itself if it isn't in a repository, or
+    None if git couldn't answer before the deadline"""
+
+    try:
+        proc = subprocess.Popen(['git', '-C', dirpath, 'rev-parse', '--show-toplevel'],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return dirpath
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            proc.kill()
+            proc.wait()
+            return None
+        time.sleep(0.002)
+    stdout = proc.communicate()[0]
+    if proc.returncode:
+        return dirpath
+    return stdout.decode('utf-8').strip()
+
+
+def get_status(fencepy_root, venv_root, dirpath, vdir=None, git=True, budget=0.05):
+    """Return a dict describing the environment of dirpath
+
+    Besides the project, virtualenv and name, the dict holds the state (one of STATES),
+    and whether the environment is active and whether its requirements have changed. The
+    project is looked up in the resolution cache; if it isn't there, git gets whatever is
+    left of budget seconds, and the state is 'stale' if that isn't enough.
+    """
+
+    deadline = time.time() + budget
+    pdir = dirpath
+    if git:
+        pdir = recall(fencepy_root, dirpath)
+        if pdir is None:
+            pdir = _git_toplevel(dirpath, deadline)
+            if pdir is None:
+                l.debug('could not resolve {0} within {1}s'.format(dirpath, budget))
+                return {'state': 'stale'}
+            remember(fencepy_root, dirpath, pdir)
+
+    vdir = vdir or os.path.join(venv_root, registry.env_name(pdir))
+    ret = {'project': pdir, 'virtualenv': vdir, 'name': os.path.basename(pdir),
+           'active': False, 'outdated': False}
+    if not os.path.isdir(vdir):
+        ret['state'] = 'missing'
+        return ret
+
+    active = os.environ.get('VIRTUAL_ENV')
+    ret['active'] = bool(active) and \
+        os.path.normcase(os.path.realpath(active)) == os.path.normcase(os.path.realpath(vdir))
+    ret['outdated'] = requirements_changed(vdir, pdir)
+    ret['state'] = 'active' if ret['active'] else 'inactive'
+    return ret
+
+
+def parse_args(argv):
+    """Return the parsed args if argv is a status command this module can handle, or None
+
+    Anything else, including status with options that only the full usage knows, is left
+    to fencepy.main
+    """
+    if 'status' not in argv:
+        return None
+    try:
+        return docopt.docopt(DOCOPT, argv=argv, help=False)
+    except docopt.DocoptExit:
+        return None
+
+
+def run(args):
+    """Print a short description of this directory's environment, for use in a shell prompt
+
+    Prints nothing and returns 1 if there is no environment
+    """
+
+    fdir = os.path.abspath(os.path.expanduser(args['--fencepy-root']))
+    info = get_status(
+        fdir, registry.get_virtualenv_root(fdir), os.path.abspath(args['--dir'] or os.getcwd()),
+        vdir=args['--virtualenv-dir'], git=not args['--no-git'],
+        budget=float(args['--budget']) / 1000
+    )
+
+    if info['state'] == 'stale':
+        print(args['--stale-marker'])
+        return 0
+    if info['state'] == 'missing':
+        return 1
+    try:
+        print(args['--format'].format(**dict(
+            info, active='*' if info['active'] else '', outdated='!' if info['outdated'] else ''
+        )))
+    except (KeyError, IndexError, ValueError) as e:
+        l.error('bad status format {0}: {1}'.format(args['--format'], e))
+        return 1
+    return 0
@@ -0,0 +1,193 @@
+"""
+fencepy.watch
+
+Watch the requirements files of registered projects and update their environments on change
+"""
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import select
+import struct
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+# set up logging
+import logging
+l = logging.getLogger(__name__)
+
+# inotify constants, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """Detect changes to files by comparing their mtime and size every interval seconds"""
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._stamps = {}
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime, st.st_size
+        except OSError:
+            return None
+
+    def watch(self, paths):
+        """Replace the set of watched files"""
+        self._stamps = dict((path, self._stamps.get(path, self._stamp(path))) for path in paths)
+
+    def wait(self, timeout):
+        """Block for up to timeout seconds, returning the set of files that changed"""
+        time.sleep(max(0, min(timeout, self.interval)))
+        changed = set()
+        for path, stamp in self._stamps.items():
+            current = self._stamp(path)
+            if current != stamp:
+                self._stamps[path] = current
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Detect changes to files through inotify watches on their directories
+
+    Directories are watched rather than files, so that editors which replace files on save
+    are still noticed
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}
+        self._paths = set()
+
+    def watch(self, paths):
+        """Replace the set of watched files"""
+        self._paths = set(paths)
+        for dirpath in set(os.path.dirname(x) for x in paths) - set(self._dirs.values()):
+            wd = self._libc.inotify_add_watch(self._fd, dirpath.encode('utf-8'), self.MASK)
+            if wd < 0:
+                l.warning('could not watch {0}'.format(dirpath))
+                continue
+            self._dirs[wd] = dirpath
+
+    def wait(self, timeout):
+        """Block for up to timeout seconds, returning the set of files that changed"""
+        if not select.select([self._fd], [], [], max(0, timeout))[0]:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                path = os.path.join(self._dirs.get(wd, ''), name)
+                if path in self._paths:
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def get_watcher(interval=2.0):
+    """Return an inotify watcher where possible, and a polling watcher otherwise"""
+    if platform.system() == 'Linux':
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            l.debug('inotify is unavailable ({0}), polling instead'.format(e))
+    return PollingWatcher(interval)
+
+
+def watch(get_targets, update, watcher, indexfile=None, debounce=2.0, jobs=2,
+          stop=None, max_wait=5.0):
+    """Run update(vdir, pdir) whenever a watched requirements file changes
+
+    get_targets returns a dict of requirements file -> (virtualenv dir, project dir), and is
+    called again whenever indexfile changes. Changes to a file are only acted upon once it
+    has been quiet for debounce seconds, at most jobs updates run at once, and an
+    environment is never updated twice at the same time. Runs until the stop event is set.
+    """
+
+    stop = stop or threading.Event()
+    lock = threading.Lock()
+    running = set()
+    rerun = set()
+    pending = {}
+    targets = {}
+
+    def refresh():
+        targets.clear()
+        targets.update(get_targets())
+        watcher.watch(list(targets) + ([indexfile] if indexfile else []))
+        l.info('watching {0} requirements files'.format(len(targets)))
+
+    def run(path, vdir, pdir):
+        try:
+            l.info('{0} changed, updating {1}'.format(path, vdir))
+            update(vdir, pdir)
+        except Exception:
+            l.exception('updating {0} failed'.format(vdir))
+        finally:
+            with lock:
+                running.discard(vdir)
+                if path in rerun:
+                    rerun.discard(path)
+                    pending[path] = time.time() + debounce
+
+    refresh()
+    pool = ThreadPool(jobs)
+    try:
+        while not stop.is_set():
+            with lock:
+                timeout = min([max_wait] + [due - time.time() for due in pending.values()])
+            changed = watcher.wait(timeout)
+            now = time.time()
+
+            if indexfile in changed:
+                changed.discard(indexfile)
+                refresh()
+
+            with lock:
+                for path in changed:
+                    if path in targets:
+                        pending[path] = now + debounce
+                for path, due in list(pending.items()):
+                    if due > now or path not in targets:
+                        continue
+                    del pending[path]
+                    vdir, pdir = targets[path]
+                    if vdir in running:
+                        rerun.add(path)
+                        continue
+                    running.add(vdir)
+                    pool.apply_async(run, (path, vdir, pdir))
+    finally:
+        pool.close()
+        pool.join()
+        watcher.close()
@@ -0,0 +1,62 @@
+from unittest import TestCase
+import tempfile
+import fencepy
+import logging
+import os
+import shutil
+
+
+class TestApi(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.fdir = os.path.join(self.tempdir, 'fencepy')
+        self.pdir = os.path.join(self.tempdir, 'project')
+        os.mkdir(self.pdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_resolve(self):
+        env = fencepy.resolve(self.pdir, fencepy_root=self.fdir, git=False)
+        self.assertEqual(env.project, self.pdir)
+        self.assertEqual(env.fencepy_root, self.fdir)
+        self.assertTrue(env.virtualenv_dir.startswith(self.fdir))
+        self.assertTrue('project' in os.path.basename(env.virtualenv_dir))
+        self.assertFalse(env.exists)
+
+        # resolving is free of side effects
+        self.assertFalse(os.path.exists(self.fdir))
+
+    def test_resolve_plugins(self):
+        env = fencepy.resolve(self.pdir, fencepy_root=self.fdir, plugins=['ps1'])
+        self.assertTrue(env.args['plugins']['ps1']['enabled'])
+        self.assertFalse(env.args['plugins']['requirements']['enabled'])
+
+    def test_create_update_erase(self):
+        handlers = list(logging.getLogger('').handlers)
+        env = fencepy.resolve(self.pdir, fencepy_root=self.fdir, git=False)
+
+        result = fencepy.create(env)
+        self.assertTrue(result.ok, 'create failed')
+        self.assertEqual(result.command, 'create')
+        self.assertTrue(result.environment.exists)
+
+        result = fencepy.create(self.pdir, fencepy_root=self.fdir, git=False)
+        self.assertFalse(result.ok, 'second create should not succeed')
+        self.assertEqual(result.status, 1)
+
+        self.assertTrue(fencepy.update(env).ok, 'update failed')
+        self.assertTrue(fencepy.erase(env).ok, 'erase failed')
+        self.assertFalse(env.exists)
+
+        # the api never touches logging configuration
+        self.assertEqual(logging.getLogger('').handlers, handlers)
+
+    def test_resolve_sees_config_changes(self):
+        config = os.path.join(self.tempdir, 'fencepy.conf')
+        for keep in ('2', '10'):
+            open(config, 'w').write('[snapshot]\nkeep = {0}\n'.format(keep))
+            env = fencepy.resolve(self.pdir, fencepy_root=self.fdir, git=False,
+                                  config_file=config)
+            self.assertEqual(env.args['settings']['snapshot']['keep'], keep)
@@ -0,0 +1,93 @@
+from unittest import TestCase
+from fencepy import archive, helpers
+from py.test import raises
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.outside = os.path.join(self.tempdir, 'outside')
+        os.mkdir(self.outside)
+        self.vdir = os.path.join(self.tempdir, 'virtualenvs', 'env')
+        os.mkdir(os.path.dirname(self.vdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _archive(self, *members):
+        """Return a gzipped tar stream of a header, then (name, symlink target or text) pairs
+        or ready-made TarInfo members without content"""
+        fileobj = io.BytesIO()
+        with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+            header = json.dumps({'virtualenv': '/old/env', 'python': helpers.pyversionstr(),
+                                 'metadata': None}).encode('utf-8')
+            for name, data in [(archive.HEADER, header)] + list(members):
+                if isinstance(name, tarfile.TarInfo):
+                    tar.addfile(name)
+                    continue
+                info = tarfile.TarInfo(name)
+                if name.endswith('/'):
+                    info.type = tarfile.DIRTYPE
+                elif isinstance(data, bytes):
+                    info.size = len(data)
+                else:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = data
+                tar.addfile(info, io.BytesIO(data) if isinstance(data, bytes) else None)
+        fileobj.seek(0)
+        return fileobj
+
+    def test_import(self):
+        archive.import_env(self._archive(
+            ('env/', None),
+            ('env/bin/', None),
+            ('env/bin/activate', b'VIRTUAL_ENV="/old/env"\n'),
+            ('env/bin/python', '/usr/bin/python')
+        ), self.vdir)
+        self.assertEqual(open(os.path.join(self.vdir, 'bin', 'activate')).read(),
+                         'VIRTUAL_ENV="{0}"\n'.format(self.vdir))
+        self.assertEqual(os.readlink(os.path.join(self.vdir, 'bin', 'python')), '/usr/bin/python')
+
+    def test_import_refuses_writes_through_symlinks(self):
+        for members in ([('env/lib', self.outside), ('env/lib/evil.txt', b'evil')],
+                        [('env/evil.txt', os.path.join(self.outside, 'evil.txt')),
+                         ('env/evil.txt', b'evil')]):
+            with raises(IOError):
+                archive.import_env(self._archive(('env/', None), *members), self.vdir)
+            self.assertEqual(os.listdir(self.outside), [])
+            self.assertEqual(os.listdir(os.path.dirname(self.vdir)), [])
+
+    def test_import_refuses_paths_outside(self):
+        for name in ('env/../evil.txt', '/tmp/evil.txt', 'other/evil.txt'):
+            with raises(IOError):
+                archive.import_env(self._archive((name, b'evil')), self.vdir)
+        self.assertEqual(os.listdir(os.path.dirname(self.vdir)), [])
+
+    def _info(self, name, kind=tarfile.REGTYPE, mode=0o644):
+        info = tarfile.TarInfo(name)
+        info.type = kind
+        info.mode = mode
+        return info, None
+
+    def test_import_refuses_special_files(self):
+        for kind in (tarfile.FIFOTYPE, tarfile.CHRTYPE, tarfile.BLKTYPE):
+            with raises(IOError):
+                archive.import_env(self._archive(
+                    ('env/', None), self._info('env/evil', kind)
+                ), self.vdir)
+            self.assertEqual(os.listdir(os.path.dirname(self.vdir)), [])
+
+    def test_import_strips_setuid(self):
+        if not hasattr(tarfile, 'tar_filter'):
+            return
+        archive.import_env(self._archive(
+            ('env/', None), self._info('env/tool', mode=0o4755)
+        ), self.vdir)
+        self.assertEqual(os.stat(os.path.join(self.vdir, 'tool')).st_mode & 0o7777, 0o755)
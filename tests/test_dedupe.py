@@ -0,0 +1,52 @@
+from unittest import TestCase
+from fencepy import dedupe
+import os
+import shutil
+import tempfile
+
+
+class TestDedupe(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.vdirs = [os.path.join(self.tempdir, 'virtualenvs', x) for x in ('one', 'two')]
+        for vdir in self.vdirs:
+            for subdir in ('lib', 'bin'):
+                os.makedirs(os.path.join(vdir, subdir))
+            self._write(vdir, 'lib', 'shared.py', 'x = 1\n' * 100)
+            self._write(vdir, 'lib', 'easy-install.pth', 'shared\n')
+            self._write(vdir, 'bin', 'tool', 'x = 1\n' * 100)
+        self._write(self.vdirs[0], 'lib', 'unique.py', 'y = 2\n' * 100)
+        self._write(self.vdirs[1], 'lib', 'unique.py', 'z = 3\n' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, vdir, subdir, name, text):
+        open(os.path.join(vdir, subdir, name), 'w').write(text)
+
+    def _ino(self, vdir, subdir, name):
+        return os.stat(os.path.join(vdir, subdir, name)).st_ino
+
+    def test_dedupe(self):
+        one, two = self.vdirs
+        self.assertEqual(dedupe.dedupe(self.vdirs, self.tempdir), (1, 600))
+        self.assertEqual(self._ino(one, 'lib', 'shared.py'), self._ino(two, 'lib', 'shared.py'))
+
+        # same size but different content, or files that are written to, are left alone
+        self.assertNotEqual(self._ino(one, 'lib', 'unique.py'), self._ino(two, 'lib', 'unique.py'))
+        for subdir, name in (('lib', 'easy-install.pth'), ('bin', 'tool')):
+            self.assertNotEqual(self._ino(one, subdir, name), self._ino(two, subdir, name))
+            self.assertEqual(os.stat(os.path.join(one, subdir, name)).st_nlink, 1)
+
+        # a second pass finds nothing to do, and reuses the cached hashes
+        self.assertEqual(dedupe.dedupe(self.vdirs, self.tempdir), (0, 0))
+        cache = dedupe.helpers.read_json(dedupe.get_cache_file(self.tempdir))
+        self.assertEqual(len(cache), 4)
+
+    def test_cache_is_invalidated_by_changes(self):
+        dedupe.dedupe(self.vdirs, self.tempdir)
+
+        # make the unique files identical, keeping their size
+        self._write(self.vdirs[1], 'lib', 'unique.py', 'y = 2\n' * 100)
+        self.assertEqual(dedupe.dedupe(self.vdirs, self.tempdir), (1, 600))
@@ -1,22 +1,24 @@
 from unittest import TestCase
 import tempfile
 import fencepy
+import fencepy.main
 import os
 import shutil
-import copy
-import sys
 import platform
 import uuid
+import json
 from py.test import raises
-from docopt import DocoptExit
-from fencepy.helpers import getoutputoserror, redirected
+from docopt import docopt, DocoptExit
+from fencepy import mirror
+from fencepy.helpers import getoutputoserror, redirected, findpybins, installed_names, \
+    get_site_packages
+from benchmarks.index import build_wheel
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
 ORIGINAL_DIR = os.getcwd()
-ORIGINAL_ARGV = copy.copy(sys.argv)
 
 
 class TestFencepy(TestCase):
@@ -24,26 +26,17 @@ class TestFencepy(TestCase):
     def _fence(self, *args):
         # always include the overridden fencepy directory
         # no logging, since that breaks tests in Windows (with overridden fencepy dir)
-        sys.argv = ['fencepy', '-F', self.fdir, '-s'] + list(args)
-        ret = fencepy.fence()
-        sys.argv = ORIGINAL_ARGV
-        return ret
+        return fencepy.fence(['-F', self.fdir, '-s'] + list(args))
 
     def _fence_no_options(self, *args):
         # help doesn't work with any options
-        sys.argv = ['fencepy'] + list(args)
-        ret = fencepy.fence()
-        sys.argv = ORIGINAL_ARGV
-        return ret
+        return fencepy.fence(list(args))
 
     def _get_arg_dict(self, *args):
         # always include the overridden fencepy directory
         # no logging, since that breaks tests in Windows (with overridden fencepy dir)
         # also, include "create" so that some command is included
-        sys.argv = ['fencepy', 'create', '-F', self.fdir, '-s'] + list(args)
-        ret = fencepy.main._get_args()
-        sys.argv = ORIGINAL_ARGV
-        return ret
+        return fencepy.main._get_args(['create', '-F', self.fdir, '-s'] + list(args))
 
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
@@ -105,6 +98,29 @@ class TestFencepy(TestCase):
         self.assertEqual(ret, 0, 'create command failed')
         self.assertTrue(os.path.exists(vdir))
 
+    def test_create_with_vdir_containing_spaces(self):
+        vdir = os.path.join(self.tempdir, 'virtual env')
+        ret = self._fence('create', '-D', vdir)
+        self.assertEqual(ret, 0, 'create command failed')
+        self.assertTrue(os.path.exists(vdir))
+
+    def test_create_venv_backend(self):
+        self._create_and_assert('-G', '-B', 'venv', '-N')
+        self.assertTrue(os.path.exists(
+            os.path.join(self.default_args['--virtualenv-dir'], 'pyvenv.cfg')
+        ))
+
+    def test_create_unknown_backend(self):
+        ret = self._fence('create', '-B', 'notabackend')
+        self.assertEqual(ret, 1, 'create command should not succeed')
+        self.assertFalse(os.path.exists(self.default_args['--virtualenv-dir']))
+
+    def test_create_without_seed(self):
+        self._create_and_assert('-G', '-N')
+        pybins = findpybins(self.default_args['--virtualenv-dir'])
+        self.assertTrue(pybins['python'] is not None)
+        self.assertTrue(pybins['pip'] is None)
+
     def test_create_with_sublime(self):
         testsdir = os.path.dirname(os.path.realpath(__file__))
         defaultfile = os.path.join(testsdir, 'sublime-project.template')
@@ -118,6 +134,26 @@ class TestFencepy(TestCase):
             path = path.replace('\\', '\\\\')
         self.assertTrue(path in open(configfile).read())
 
+    def test_update_with_sublime_unchanged(self):
+        configfiles = [os.path.join(self.pdir, '{0}.sublime-project'.format(name))
+                       for name in (self.pname, 'other')]
+        for configfile in configfiles:
+            open(configfile, 'w').write('{"zzz": 1, "folders": []}')
+        self.test_create_plain()
+
+        # every project file is configured, and existing keys keep their order
+        for configfile in configfiles:
+            text = open(configfile).read()
+            self.assertTrue('python_interpreter' in text)
+            self.assertTrue(text.index('zzz') < text.index('folders') < text.index('settings'))
+            os.utime(configfile, (0, 0))
+
+        # nothing changed, so nothing should be written
+        ret = self._fence('update', '-G')
+        self.assertEqual(ret, 0, 'update command failed')
+        for configfile in configfiles:
+            self.assertEqual(os.path.getmtime(configfile), 0)
+
     def test_create_with_requirements(self):
         open(os.path.join(self.pdir, 'requirements.txt'), 'w').write('requests')
         self.test_create_plain()
@@ -128,6 +164,52 @@ class TestFencepy(TestCase):
                 break
         self.assertTrue(requests_installed, 'requests module is not installed')
 
+    def test_create_offline_from_mirror(self):
+        mirror_dir = mirror.get_mirror_dir(self.fdir)
+        os.makedirs(mirror.get_files_dir(mirror_dir))
+        build_wheel(mirror.get_files_dir(mirror_dir), 'fencepymirrored')
+        mirror.rebuild_index(mirror_dir)
+        open(os.path.join(self.pdir, 'requirements.txt'), 'w').write('fencepymirrored')
+        self._create_and_assert('-G', '--offline')
+        vdir = self.default_args['--virtualenv-dir']
+        self.assertTrue('fencepymirrored' in installed_names(vdir))
+
+    def test_create_falls_back_to_mirror(self):
+        # the package only exists in the mirror, so pip fails against the real index
+        mirror_dir = mirror.get_mirror_dir(self.fdir)
+        os.makedirs(mirror.get_files_dir(mirror_dir))
+        build_wheel(mirror.get_files_dir(mirror_dir), 'fencepymirrored')
+        mirror.rebuild_index(mirror_dir)
+        open(os.path.join(self.pdir, 'requirements.txt'), 'w').write('fencepymirrored')
+        self._create_and_assert('-G')
+        vdir = self.default_args['--virtualenv-dir']
+        self.assertTrue('fencepymirrored' in installed_names(vdir))
+
+    def test_update_unchanged_requirements_from_mirror(self):
+        self.test_create_falls_back_to_mirror()
+
+        # unchanged requirements are neither downloaded nor indexed again
+        simple_dir = os.path.join(mirror.get_mirror_dir(self.fdir), 'simple')
+        shutil.rmtree(simple_dir)
+        self.assertEqual(self._fence('update', '-G'), 0, 'update command failed')
+        self.assertFalse(os.path.exists(simple_dir))
+
+    def test_create_with_local_package(self):
+        # building it needs setuptools, which the mirror never holds
+        pkgdir = os.path.join(self.pdir, 'localpkg')
+        os.mkdir(pkgdir)
+        open(os.path.join(pkgdir, 'setup.py'), 'w').write(
+            'from setuptools import setup\nsetup(name="fencepylocal", version="1.0")\n'
+        )
+        open(os.path.join(self.pdir, 'requirements.txt'), 'w').write('-e {0}\n'.format(pkgdir))
+        self._create_and_assert('-G')
+        vdir = self.default_args['--virtualenv-dir']
+        self.assertTrue('fencepylocal' in installed_names(vdir))
+
+        # it wasn't installed from the mirror, so an update can't assume it's there
+        self.assertEqual(fencepy.registry.read_metadata(vdir)['mirrored'], None)
+        self.assertEqual(self._fence('update', '-G'), 0, 'update command failed')
+
     def test_create_twice(self):
         self.test_create_plain()
         with raises(AssertionError):
@@ -180,6 +262,325 @@ class TestFencepy(TestCase):
         self.assertFalse(args['plugins']['ps1']['enabled'])
         self.assertFalse(args['plugins']['sublime']['enabled'])
 
+        # a section that doesn't say whether the plugin is enabled changes nothing else
+        config = os.path.join(self.tempdir, 'offline.conf')
+        open(config, 'w').write(os.linesep.join(['[requirements]', 'offline = true']))
+        args = self._get_arg_dict('-C', config)
+        self.assertEqual(args['plugins']['requirements']['offline'], 'true')
+        for plugin in fencepy.plugins.PLUGINS:
+            self.assertTrue(args['plugins'][plugin]['enabled'])
+
+    def test_log_tail_json(self):
+        lines = ['[log]', 'format = json']
+        open(os.path.join(self.fdir, 'fencepy.conf'), 'w').write(os.linesep.join(lines))
+        self.assertEqual(fencepy.fence(['create', '-F', self.fdir, '-q', '-G']), 0,
+                         'create command failed')
+        tempout = StringIO()
+        with redirected(out=tempout):
+            ret = self._fence('log', 'tail', '--json', '-n', '1')
+        self.assertEqual(ret, 0, 'log tail command failed')
+        record = json.loads(tempout.getvalue())
+        self.assertEqual(record['command'], 'create')
+        self.assertEqual(record['project'], self.pdir)
+        self.assertEqual(record['status'], 0)
+        self.assertTrue(record['elapsed'] >= 0)
+
+    def _doctor_report(self, *args):
+        tempout = StringIO()
+        with redirected(out=tempout):
+            ret = self._fence('doctor', '-G', '--json', *args)
+        return ret, json.loads(tempout.getvalue())
+
+    def test_doctor_healthy(self):
+        self.test_create_plain()
+        ret, report = self._doctor_report()
+        self.assertEqual(ret, 0, 'doctor command failed')
+        self.assertEqual(len(report), 1)
+        self.assertTrue(report[0]['healthy'])
+        self.assertEqual(report[0]['problems'], {})
+
+    def test_doctor_repairs_interpreter(self):
+        self.test_create_plain()
+        python = os.path.join(self.default_args['--virtualenv-dir'], 'bin', 'python')
+        if platform.system() == 'Windows':
+            return
+        os.remove(python)
+        os.symlink(os.path.join(self.tempdir, 'nonexistent'), python)
+
+        ret, report = self._doctor_report('--no-repair')
+        self.assertEqual(ret, 1, 'broken environment reported as healthy')
+        self.assertTrue('interpreter' in report[0]['problems'])
+        self.assertTrue(os.path.islink(python) and not os.path.exists(python))
+
+        ret, report = self._doctor_report()
+        self.assertEqual(ret, 0, 'doctor command failed')
+        self.assertEqual(report[0]['repaired'], {'interpreter': True})
+        self.assertTrue(os.path.exists(python))
+
+    def test_doctor_missing_requirements(self):
+        self.test_create_plain()
+        open(os.path.join(self.pdir, 'requirements.txt'), 'w').write('pip\nnotinstalled>=1.0\n')
+        ret, report = self._doctor_report('--no-repair')
+        self.assertEqual(ret, 1, 'missing requirements reported as healthy')
+        self.assertTrue('notinstalled>=1.0' in report[0]['problems']['requirements'])
+        self.assertFalse('pip' in report[0]['problems']['requirements'].split(': ')[1])
+
+    def _snapshot(self, *args):
+        tempout = StringIO()
+        with redirected(out=tempout):
+            ret = self._fence('snapshot', '-G', *args)
+        self.assertEqual(ret, 0, 'snapshot command failed')
+        return tempout.getvalue().split()
+
+    def test_snapshot_and_rollback(self):
+        self.test_create_plain()
+        vdir = self.default_args['--virtualenv-dir']
+        name = self._snapshot()[0]
+        self.assertEqual(self._snapshot('--list'), [name])
+
+        # unchanged files are shared with the live environment
+        sroot = fencepy.snapshots.get_snapshot_root(self.fdir, vdir)
+        python = os.path.join('bin', 'python')
+        if platform.system() != 'Windows':
+            self.assertTrue(os.path.islink(os.path.join(sroot, name, python)))
+        pkgdir = findpybins(vdir)['pip']
+        self.assertEqual(os.stat(pkgdir).st_ino,
+                         os.stat(os.path.join(sroot, name, os.path.relpath(pkgdir, vdir))).st_ino)
+
+        # a bad change is undone by the rollback
+        badfile = os.path.join(vdir, 'badfile')
+        open(badfile, 'w').write('bad')
+        ret = self._fence('rollback', '-G')
+        self.assertEqual(ret, 0, 'rollback command failed')
+        self.assertFalse(os.path.exists(badfile))
+        self.assertTrue(os.path.exists(os.path.join(vdir, python)))
+        self.assertFalse(os.path.exists('{0}.rollback'.format(vdir)))
+
+        self.assertEqual(self._fence('rollback', '-G', '-T', 'notasnapshot'), 1)
+
+    def test_exchange(self):
+        first, second = [os.path.join(self.tempdir, x) for x in ('first', 'second')]
+        for path in (first, second):
+            os.mkdir(path)
+            open(os.path.join(path, os.path.basename(path)), 'w').write('')
+        if not fencepy.snapshots.exchange(first, second):
+            return
+        self.assertEqual(os.listdir(first), ['second'])
+        self.assertEqual(os.listdir(second), ['first'])
+
+    def test_export_and_import(self):
+        self.test_create_plain()
+        vdir = self.default_args['--virtualenv-dir']
+        archive = os.path.join(self.tempdir, 'env.tar.gz')
+        self.assertEqual(self._fence('export', '-o', archive), 0, 'export command failed')
+
+        # import under a different project, so every absolute path has to change
+        otherdir = os.path.join(self.tempdir, 'other')
+        os.mkdir(otherdir)
+        otherv = self._get_arg_dict('-d', otherdir)['--virtualenv-dir']
+        ret = self._fence('import', '-G', '-d', otherdir, '-i', archive)
+        self.assertEqual(ret, 0, 'import command failed')
+        try:
+            activate = open(os.path.join(otherv, 'bin', 'activate')).read()
+            self.assertIn(otherv, activate)
+            self.assertNotIn(vdir, activate)
+            self.assertEqual(fencepy.registry.lookup(self.fdir, otherv), otherdir)
+            self.assertEqual(fencepy.registry.read_metadata(otherv)['imported_from'], vdir)
+            self.assertFalse(os.path.exists('{0}.import'.format(otherv)))
+            getoutputoserror([findpybins(otherv)['python'], '-c', 'import sys'])
+
+            # an existing environment is never overwritten
+            self.assertEqual(self._fence('import', '-G', '-d', otherdir, '-i', archive), 1)
+        finally:
+            shutil.rmtree(otherv)
+
+    def test_import_rejects_garbage(self):
+        garbage = os.path.join(self.tempdir, 'garbage.tar.gz')
+        open(garbage, 'wb').write(b'not an archive')
+        self.assertEqual(self._fence('import', '-G', '-i', garbage), 1)
+        self.assertFalse(os.path.exists(self.default_args['--virtualenv-dir']))
+
+    def _status(self, *args):
+        tempout = StringIO()
+        with redirected(out=tempout):
+            ret = self._fence('status', *args)
+        return ret, tempout.getvalue().strip()
+
+    def test_status(self):
+        self.assertEqual(self._status('-G'), (1, ''))
+        self.test_create_plain()
+        vdir = self.default_args['--virtualenv-dir']
+        self.assertEqual(self._status('-G'), (0, self.pname))
+
+        fmt = '{state}:{name}{active}{outdated}'
+        old = os.environ.get('VIRTUAL_ENV')
+        os.environ['VIRTUAL_ENV'] = vdir
+        try:
+            self.assertEqual(self._status('-G', '--format', fmt),
+                             (0, 'active:{0}*'.format(self.pname)))
+        finally:
+            if old is None:
+                del os.environ['VIRTUAL_ENV']
+            else:
+                os.environ['VIRTUAL_ENV'] = old
+
+        # new requirements make the environment outdated, until they are installed
+        rtxt = os.path.join(self.pdir, 'requirements.txt')
+        open(rtxt, 'w').write('')
+        self.assertEqual(self._status('-G', '--format', fmt),
+                         (0, 'inactive:{0}!'.format(self.pname)))
+        self.assertEqual(self._fence('update', '-G'), 0, 'update command failed')
+        self.assertEqual(self._status('-G', '--format', fmt),
+                         (0, 'inactive:{0}'.format(self.pname)))
+
+        # a no-op update leaves the recorded fingerprint alone
+        metadata = os.path.join(vdir, fencepy.registry.METADATA)
+        os.utime(metadata, (0, 0))
+        self.assertEqual(self._fence('update', '-G'), 0, 'update command failed')
+        self.assertEqual(os.path.getmtime(metadata), 0)
+        os.utime(rtxt, None)
+        self.assertEqual(self._status('-G'), (0, self.pname))
+
+    def test_status_usage_matches(self):
+        # status is parsed with its own, cut-down usage, which must agree with the full one
+        argv = ['status', '-F', self.fdir, '-G', '--budget', '10', '-s']
+        full = docopt(fencepy.main.DOCOPT, argv=argv)
+        short = fencepy.status.parse_args(argv)
+        self.assertEqual(short, dict((k, full[k]) for k in short))
+        self.assertEqual(fencepy.status.parse_args(['create', '-d', 'status']), None)
+        self.assertEqual(fencepy.status.parse_args(['status', '-B', 'venv']), None)
+
+    def test_status_cache(self):
+        # any other command remembers the directory's project
+        cachefile = fencepy.status.get_cache_file(self.fdir)
+        self.assertEqual(fencepy.status.recall(self.fdir, os.getcwd()), self.default_args['--dir'])
+        self.assertEqual(self._status('--budget', '0'), (1, ''))
+
+        # with no time to ask git, an unknown directory gets the stale marker
+        os.remove(cachefile)
+        self.assertEqual(self._status('--budget', '0'), (0, '?'))
+        self.assertEqual(self._status('--budget', '0', '--stale-marker', '...'), (0, '...'))
+
+        # an entry no longer counts once the directory is in a different repository
+        fencepy.status.remember(self.fdir, self.pdir, self.pdir)
+        getoutputoserror('git init .')
+        self.assertEqual(fencepy.status.recall(self.fdir, self.pdir), None)
+        self.assertEqual(self._status('--budget', '0'), (0, '?'))
+
+        # the oldest entries and directories that are gone are dropped
+        size = fencepy.status.CACHE_SIZE
+        fencepy.status.CACHE_SIZE = 2
+        try:
+            dirs = [os.path.join(self.tempdir, str(x)) for x in range(3)]
+            for dirpath in dirs:
+                os.mkdir(dirpath)
+                fencepy.status.remember(self.fdir, dirpath, dirpath)
+            self.assertEqual(sorted(fencepy.helpers.read_json(cachefile)), dirs[1:])
+            os.rmdir(dirs[1])
+            fencepy.status.remember(self.fdir, dirs[0], dirs[0])
+            self.assertEqual(sorted(fencepy.helpers.read_json(cachefile)), [dirs[0], dirs[2]])
+        finally:
+            fencepy.status.CACHE_SIZE = size
+
+    def test_dedupe(self):
+        self.test_create_plain()
+        otherdir = os.path.join(self.tempdir, 'other')
+        os.mkdir(otherdir)
+        self.assertEqual(self._fence('create', '-G', '-d', otherdir), 0, 'create command failed')
+        otherv = self._get_arg_dict('-d', otherdir)['--virtualenv-dir']
+        try:
+            self.assertEqual(self._fence('dedupe'), 0, 'dedupe command failed')
+            inodes = [os.stat(os.path.join(get_site_packages(x)[0], 'pip', '__init__.py')).st_ino
+                      for x in (self.default_args['--virtualenv-dir'], otherv)]
+            self.assertEqual(inodes[0], inodes[1])
+        finally:
+            shutil.rmtree(otherv)
+
+    def test_create_with_limits(self):
+        lines = ['[limits]', 'jobs = 1', 'nice = 1', 'build-jobs = 2']
+        open(os.path.join(self.fdir, 'fencepy.conf'), 'w').write(os.linesep.join(lines))
+        self._create_and_assert('-G')
+        self.assertEqual(os.listdir(fencepy.resources.get_lock_dir(self.fdir)), ['slot-0'])
+
+    def test_relative_fencepy_root(self):
+        self.test_create_plain()
+        os.chdir(self.tempdir)
+        tempout = StringIO()
+        with redirected(out=tempout):
+            fencepy.fence(['list', '--json', '-s', '-F', os.path.basename(self.fdir)])
+        self.assertEqual([x['virtualenv'] for x in json.loads(tempout.getvalue())],
+                         [self.default_args['--virtualenv-dir']])
+
+    def test_bad_limits(self):
+        config = os.path.join(self.tempdir, 'badlimits.conf')
+        open(config, 'w').write(os.linesep.join(['[limits]', 'ionice = realtime']))
+        with raises(ValueError):
+            self._get_arg_dict('-C', config)
+
+    def test_snapshot_retention(self):
+        self.test_create_plain()
+        lines = ['[snapshot]', 'keep = 2']
+        open(os.path.join(self.fdir, 'fencepy.conf'), 'w').write(os.linesep.join(lines))
+        names = [self._snapshot()[0] for _ in range(3)]
+        self.assertEqual(self._snapshot('--list'), names[1:])
+
+        # keeping nothing would delete the snapshot that was just taken
+        config = os.path.join(self.tempdir, 'keepnone.conf')
+        open(config, 'w').write(os.linesep.join(['[snapshot]', 'keep = 0']))
+        self.assertEqual(self._fence('snapshot', '-G', '-C', config), 1)
+        self.assertEqual(self._snapshot('--list'), names[1:])
+
+    def test_snapshot_roots_are_per_environment(self):
+        first = fencepy.snapshots.get_snapshot_root(self.fdir, os.path.join('/a', '.venv'))
+        second = fencepy.snapshots.get_snapshot_root(self.fdir, os.path.join('/b', '.venv'))
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.basename(first).startswith('.venv-'))
+
+    def test_create_records_metadata(self):
+        self.test_create_plain()
+        vdir = self.default_args['--virtualenv-dir']
+        metadata = fencepy.registry.read_metadata(vdir)
+        self.assertEqual(metadata['project'], self.pdir)
+        self.assertEqual(metadata['backend'], 'virtualenv')
+        self.assertEqual(fencepy.registry.lookup(self.fdir, vdir), self.pdir)
+
+        tempout = StringIO()
+        with redirected(out=tempout):
+            self._fence('list', '--json')
+        self.assertEqual(json.loads(tempout.getvalue()), [
+            {'virtualenv': vdir, 'project': self.pdir, 'missing': False}
+        ])
+
+        self._fence('erase')
+        self.assertEqual(fencepy.registry.lookup(self.fdir, vdir), None)
+
+    def test_migrate_legacy_environment(self):
+        venv_root = fencepy.main._get_virtualenv_root(self.fdir)
+        legacy = os.path.join(venv_root, fencepy.registry.legacy_name(self.pdir))
+        self.assertEqual(self._fence('create', '-G', '-D', legacy), 0, 'create command failed')
+        self.assertNotEqual(legacy, self.default_args['--virtualenv-dir'])
+
+        # any command against the project moves the environment to its new name
+        self.assertEqual(self._fence('update', '-G'), 0, 'update command failed')
+        vdir = self.default_args['--virtualenv-dir']
+        self.assertFalse(os.path.exists(legacy))
+        self.assertEqual(fencepy.registry.lookup(self.fdir, vdir), self.pdir)
+        pip = findpybins(vdir)['pip']
+        self.assertTrue(open(pip).readline().startswith('#!{0}'.format(vdir)))
+
+    def test_gc(self):
+        self.test_create_plain()
+        vdir = self.default_args['--virtualenv-dir']
+        os.chdir(ORIGINAL_DIR)
+        shutil.rmtree(self.pdir)
+        original_input = __builtins__['input']
+        __builtins__['input'] = lambda _: 'y'
+        with redirected(out=StringIO()):
+            ret = self._fence('gc', '-G')
+        __builtins__['input'] = original_input
+        self.assertEqual(ret, 0, 'gc command failed')
+        self.assertFalse(os.path.exists(vdir))
+
     def test_help(self):
         tempout = StringIO()
         with redirected(out=tempout):
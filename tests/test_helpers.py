@@ -1,6 +1,9 @@
 from unittest import TestCase
 from py.test import raises
 from fencepy import helpers
+import os
+import shutil
+import tempfile
 
 
 class TestHelpers(TestCase):
@@ -24,7 +27,11 @@ class TestHelpers(TestCase):
             }
         }
 
-        helpers.pseudo_merge_dict(dto, dfrom)
+        self.assertTrue(helpers.pseudo_merge_dict(dto, dfrom))
+        self.assertEqual(dto, expected)
+
+        # merging the same data a second time is a no-op
+        self.assertFalse(helpers.pseudo_merge_dict(dto, dfrom))
         self.assertEqual(dto, expected)
 
     def test_pseudo_merge_dict_bad_dfrom(self):
@@ -53,3 +60,73 @@ class TestHelpers(TestCase):
         for error in ('bad', '10', None, 1, 'truee'):
             with raises(ValueError):
                 helpers.str2bool(error)
+
+    def _make_fake_env(self, root, *names):
+        bindir = os.path.join(root, 'bin')
+        os.makedirs(bindir)
+        for name in names:
+            open(os.path.join(bindir, name), 'w').close()
+        return bindir
+
+    def test_findpybins(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            vdir = os.path.join(tempdir, 'venv')
+            bindir = self._make_fake_env(vdir, 'python', 'pip')
+            pybins = helpers.findpybins(vdir)
+            self.assertEqual(pybins['python'], os.path.join(bindir, 'python'))
+            self.assertEqual(pybins['pip'], os.path.join(bindir, 'pip'))
+            self.assertEqual(pybins['virtualenv'], None)
+            self.assertEqual(helpers.findpybin('python', os.path.join(bindir, 'python')),
+                             os.path.join(bindir, 'python'))
+            with raises(IOError):
+                helpers.findpybin('virtualenv', vdir)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_findpybins_cached(self):
+        tempdir = tempfile.mkdtemp()
+        original_scan = helpers._scan_pybins
+        try:
+            vdir = os.path.join(tempdir, 'venv')
+            bindir = self._make_fake_env(vdir, 'python', 'pip')
+            expected = helpers.findpybins(vdir, tempdir)
+            self.assertTrue(os.path.exists(os.path.join(tempdir, helpers.PYBIN_CACHE)))
+
+            # a fresh process should be able to answer from the on-disk cache alone
+            helpers._pybin_memo.clear()
+
+            def no_scan(*args):
+                raise AssertionError('filesystem was probed')
+            helpers._scan_pybins = no_scan
+            self.assertEqual(helpers.findpybins(vdir, tempdir), expected)
+
+            # adding an executable invalidates the entry
+            helpers._scan_pybins = original_scan
+            open(os.path.join(bindir, 'virtualenv'), 'w').close()
+            os.utime(bindir, (0, 0))
+            self.assertEqual(helpers.findpybin('virtualenv', vdir, tempdir),
+                             os.path.join(bindir, 'virtualenv'))
+        finally:
+            helpers._scan_pybins = original_scan
+            shutil.rmtree(tempdir)
+
+    def test_read_requirements(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            rtxt = os.path.join(tempdir, 'requirements.txt')
+            open(rtxt, 'w').write('\n'.join([
+                '# a comment',
+                'Some_Package>=1.0  # trailing comment',
+                'other.package[extra]==2.0',
+                '-r more-requirements.txt',
+                '-e git+https://example.com/repo.git#egg=thing',
+                'https://example.com/archive.tar.gz',
+                ''
+            ]))
+            self.assertEqual(helpers.read_requirements(rtxt), [
+                ('some-package', 'Some_Package>=1.0'),
+                ('other-package', 'other.package[extra]==2.0')
+            ])
+        finally:
+            shutil.rmtree(tempdir)
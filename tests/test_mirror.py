@@ -0,0 +1,48 @@
+from unittest import TestCase
+from fencepy import mirror
+import os
+import shutil
+import tempfile
+
+
+class TestMirror(TestCase):
+
+    def test_project_name(self):
+        for filename, name in [
+            ('requests-2.9.1-py2.py3-none-any.whl', 'requests'),
+            ('Some_Package-1.0-py3-none-any.whl', 'some-package'),
+            ('zope.interface-4.1.3.tar.gz', 'zope-interface'),
+            ('python-dateutil-2.4.2.tar.gz', 'python-dateutil'),
+            ('thing-1.0.zip', 'thing'),
+            ('hashes.json', None)
+        ]:
+            self.assertEqual(mirror.project_name(filename), name)
+
+    def test_rebuild_index(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            files_dir = mirror.get_files_dir(tempdir)
+            os.makedirs(files_dir)
+            self.assertFalse(mirror.has_packages(tempdir))
+            for filename in ('Foo_Bar-1.0-py3-none-any.whl', 'foo-bar-1.1.tar.gz', 'baz-2.0.zip'):
+                open(os.path.join(files_dir, filename), 'w').write(filename)
+            mirror.rebuild_index(tempdir)
+            self.assertTrue(mirror.has_packages(tempdir))
+
+            simple_dir = os.path.join(tempdir, 'simple')
+            self.assertEqual(sorted(os.listdir(simple_dir)), ['baz', 'foo-bar', 'index.html'])
+            page = open(os.path.join(simple_dir, 'foo-bar', 'index.html')).read()
+            self.assertTrue('../../files/Foo_Bar-1.0-py3-none-any.whl#sha256=' in page)
+            self.assertTrue('../../files/foo-bar-1.1.tar.gz#sha256=' in page)
+            self.assertTrue(mirror.get_index_url(tempdir).startswith('file:'))
+
+            # nothing is rewritten when nothing was added
+            pages = [os.path.join(simple_dir, 'index.html'),
+                     os.path.join(simple_dir, 'baz', 'index.html'),
+                     os.path.join(tempdir, mirror.HASH_CACHE)]
+            for page in pages:
+                os.utime(page, (0, 0))
+            mirror.rebuild_index(tempdir)
+            self.assertEqual([os.path.getmtime(x) for x in pages], [0, 0, 0])
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+from fencepy import registry
+import os
+import shutil
+import tempfile
+
+
+class TestRegistry(TestCase):
+
+    def test_env_name_is_collision_free(self):
+        # the legacy scheme maps both of these to the same name
+        first, second = '/a/b/proj', '/ab/bc/proj'
+        self.assertEqual(registry.legacy_name(first), registry.legacy_name(second))
+        self.assertNotEqual(registry.env_name(first), registry.env_name(second))
+        self.assertTrue(registry.env_name(first).startswith('proj-'))
+        self.assertEqual(registry.env_name(first), registry.env_name('/a/b/../b/proj'))
+
+    def test_index(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            vdir = os.path.join(tempdir, 'virtualenvs', 'env')
+            registry.register(tempdir, vdir, '/some/project')
+            self.assertEqual(registry.lookup(tempdir, vdir), '/some/project')
+            registry.unregister(tempdir, vdir)
+            self.assertEqual(registry.lookup(tempdir, vdir), None)
+            self.assertEqual(registry.load_index(tempdir), {})
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_relocate(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            old = os.path.join(tempdir, 'old')
+            bindir = os.path.join(tempdir, 'new', 'bin')
+            os.makedirs(bindir)
+            open(os.path.join(bindir, 'pip'), 'w').write('#!{0}/bin/python\n'.format(old))
+            open(os.path.join(bindir, 'binary'), 'wb').write(old.encode() + b'\0')
+            new = os.path.dirname(bindir)
+            self.assertEqual(registry.relocate(new, old, new), 1)
+            self.assertEqual(open(os.path.join(bindir, 'pip')).read(),
+                             '#!{0}/bin/python\n'.format(new))
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,78 @@
+from unittest import TestCase
+from fencepy import resources
+from fencepy.helpers import getoutputoserror
+from py.test import raises
+import os
+import platform
+import psutil
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+class TestResources(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_slot_limits_concurrency(self):
+        events = []
+
+        def job(name):
+            with resources.slot(self.tempdir, 1, poll=0.01):
+                events.append('start {0}'.format(name))
+                time.sleep(0.1)
+                events.append('end {0}'.format(name))
+
+        threads = [threading.Thread(target=job, args=(x,)) for x in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the second job only starts once the first has finished
+        self.assertEqual([x.split()[0] for x in events], ['start', 'end', 'start', 'end'])
+        self.assertEqual(os.listdir(resources.get_lock_dir(self.tempdir)), ['slot-0'])
+
+    def test_slot_without_limit(self):
+        with resources.slot(self.tempdir, 0) as slot:
+            self.assertEqual(slot, None)
+        self.assertFalse(os.path.exists(resources.get_lock_dir(self.tempdir)))
+
+    def test_validate(self):
+        resources.validate({'nice': '10', 'ionice': 'idle', 'jobs': '2', 'build-jobs': '0'})
+        for name, value in (('nice', 'low'), ('nice', '20'), ('jobs', '-1'),
+                            ('build-jobs', 'many'), ('ionice', 'realtime')):
+            limits = {'nice': '0', 'ionice': '', 'jobs': '0', 'build-jobs': '0'}
+            limits[name] = value
+            with raises(ValueError):
+                resources.validate(limits)
+
+    def test_build_jobs(self):
+        self.assertEqual(resources.get_environ({'build-jobs': '0'}), None)
+        output = getoutputoserror([
+            sys.executable, '-c', 'import os; print(os.environ["MAKEFLAGS"])'
+        ], {'build-jobs': '2', 'nice': '0', 'ionice': ''})
+        self.assertEqual(output.strip(), '-j2')
+
+    def test_lower_priority(self):
+        if platform.system() == 'Windows':
+            return
+        proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)'])
+        try:
+            before = psutil.Process(proc.pid).nice()
+            resources.lower_priority(proc.pid, {'nice': str(before + 1), 'ionice': 'idle'})
+            self.assertEqual(psutil.Process(proc.pid).nice(), before + 1)
+
+            # priority is never raised
+            resources.lower_priority(proc.pid, {'nice': '1', 'ionice': ''})
+            self.assertEqual(psutil.Process(proc.pid).nice(), max(before + 1, 1))
+        finally:
+            proc.kill()
+            proc.wait()
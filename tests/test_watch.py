@@ -0,0 +1,52 @@
+from unittest import TestCase
+from fencepy import watch
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+
+class TestWatch(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.rtxt = os.path.join(self.tempdir, 'requirements.txt')
+        open(self.rtxt, 'w').write('one\n')
+        self.updates = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _watch_and_edit(self, watcher):
+        stop = threading.Event()
+        thread = threading.Thread(target=watch.watch, kwargs={
+            'get_targets': lambda: {self.rtxt: ('venv', self.tempdir)},
+            'update': lambda vdir, pdir: self.updates.append((vdir, pdir)),
+            'watcher': watcher,
+            'debounce': 0.3,
+            'stop': stop,
+            'max_wait': 0.05
+        })
+        thread.start()
+        try:
+            time.sleep(0.2)
+
+            # a burst of edits only causes one update
+            for i in range(3):
+                open(self.rtxt, 'w').write('one\n' * (i + 2))
+                time.sleep(0.05)
+            time.sleep(1.0)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(self.updates, [('venv', self.tempdir)])
+
+    def test_watch_polling(self):
+        self._watch_and_edit(watch.PollingWatcher(interval=0.05))
+
+    def test_watch_inotify(self):
+        if platform.system() != 'Linux':
+            return
+        self._watch_and_edit(watch.InotifyWatcher())